@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 from __future__ import print_function
-import portage
 import subprocess
 import base64
 import os
@@ -12,6 +11,7 @@ import socket
 import time
 import traceback
 import helpers
+import pump
 import binascii
 from subprocess import PIPE, Popen, check_output
 
@@ -27,14 +27,9 @@ global buf
 buf = ""
 uniq_code = ""
 
-# Save a reference to the portage tree
-try:
-    db = portage.db[portage.root]["porttree"].dbapi
-except KeyError:
-    db = portage.db[portage.root]["vartree"].dbapi
-
-# Query active USE flags for current environment
-use = portage.settings["USE"].split()
+# portage is only loaded when it is first needed, so importing this
+# module (for eg. from the tests) does not load the whole tree
+tree = helpers.LazyPortage()
 
 
 def _exit(retcode):
@@ -133,7 +128,7 @@ def dep_resolve(cpv, combo):
     if "USE" in my_env:
         my_env["USE"] += " " + " ".join(combo)
     else:
-        my_env["USE"] = portage.settings["USE"] + " " + " ".join(combo)
+        my_env["USE"] = tree.settings["USE"] + " " + " ".join(combo)
 
     #TODO Add to file corresponding to the particular package instead
     my_env["USE"] += " test "
@@ -142,8 +137,10 @@ def dep_resolve(cpv, combo):
     # dependencies (highest possible version)
     args = ['emerge', '-pUuD', "=" + cpv]
     process = Popen(args, env=my_env, stdout=PIPE, stderr=PIPE)
+    # communicate() reads stderr too, so emerge never blocks on it
+    out, err = process.communicate()
     deps = []
-    for line in process.stdout:
+    for line in out.splitlines():
         line = line.decode(encoding='UTF-8')
 
         # Retrieve the lines that show dependencies present
@@ -178,75 +175,37 @@ if __name__ == "__main__":
         if "USE" in my_env:
             my_env["USE"] += " " + use_combo
         else:
-            my_env["USE"] = portage.settings["USE"] + " " + use_combo
+            my_env["USE"] = tree.settings["USE"] + " " + use_combo
         my_env["USE"] += " test "
 
+        # Every line of output is logged (with the time and stream it came
+        # from) and printed as soon as it is read, from stdout and stderr
+        # alike
+        log_file = pump.LogFile(folder_name + "emerge_logs")
+        console = pump.Console()
+
+        # If changes have been written to config files, the emerge command
+        # has to be run a second time. TODO Find a better way to do this.
+        autounmask = pump.Detector()
+
         args = ['emerge', '-UuD', '--autounmask-write', "--backtrack=50", "=" + cpv]
         unmask = Popen(args, env=my_env, stdout=PIPE, stderr=PIPE)
-
-        # This boolean flag takes care of running the emerge command a second
-        # time if the first run causes a change in config file changes due to
-        # autounmask-write
-        retry = False
-
-        for line in iter(unmask.stdout.readline, b""):
-            append_log(line)
-            # If changes have been written to config files, then this condition
-            # should return true. TODO Find a better way to do this.
-            if 'Autounmask changes' in line or re.search('needs? updating', line):
-                retry = True
-            if re.search(r'(keyword|USE) changes', line):
-                retry = True
-            line = line[:77] + re.sub('.', '.', line[77:80])
-            print(line, end=('' if line[-1] == '\n' else '\n'))
-
-        for line in iter(unmask.stderr.readline, b""):
-            append_log(line)
-            if 'Autounmask changes' in line or re.search('needs? updating', line):
-                retry = True
-            if re.search(r'(keyword|USE) changes', line):
-                retry = True
-            line = line[:77] + re.sub('.', '.', line[77:80])
-            print(line, end=('' if line[-1] == '\n' else '\n'))
-
-        unmask.wait()
+        pump.pump(unmask, [log_file, autounmask, console])
         _print("The return code was: ", unmask.returncode)
 
-        if retry:
+        if autounmask.matched is not None:
             # Use etc-update to commit the automask changes to file
             yes = Popen(['yes'], stdout=PIPE)
             etc = Popen(['etc-update', '--automode', '-3'],
                         stdin=yes.stdout, stdout=PIPE, stderr=PIPE)
-
-            # Save and log the output
-            for line in iter(etc.stdout.readline, b""):
-                append_log(line)
-                line = line[:77] + re.sub('.', '.', line[77:80])
-                print(line, end='')
-
-            # Save and log the output
-            for line in iter(etc.stderr.readline, b""):
-                append_log(line)
-                line = line[:77] + re.sub('.', '.', line[77:80])
-                print(line, end='')
-            etc.wait()
+            pump.pump(etc, [log_file, console])
             yes.terminate()
 
             # Finally, run the build.
             emm = Popen(['emerge', '-UuD', "--backtrack=50", "=" + cpv], stdout=PIPE,
                         stderr=PIPE)
-            for line in iter(emm.stdout.readline, b""):
-                append_log(line)
-                line = line[:77] + re.sub('.', '.', line[77:80])
-                print(line, end=('' if line[-1] == '\n' else '\n'))
-
-            for line in iter(emm.stderr.readline, b""):
-                append_log(line)
-                line = line[:77] + re.sub('.', '.', line[77:80])
-                print(line, end=('' if line[-1] == '\n' else '\n'))
-
             # If return code != 0 (i.e. The build failed)
-            if emm.wait() != 0:
+            if pump.pump(emm, [log_file, console]) != 0:
                 # Check to see if internet is working
                 if helpers.internet_working:
                     _exit(emm.returncode)
@@ -3,8 +3,8 @@ from __future__ import print_function
 from subprocess import PIPE, Popen
 import base64
 import binascii
+import helpers
 import os
-import portage
 import random
 import re
 import requests
@@ -15,14 +15,9 @@ import socket
 import time
 global uniq_code
 
-"""Save a reference to the portage tree"""
-try:
-    db = portage.db[portage.root]["porttree"].dbapi
-except KeyError:
-    db = portage.db[portage.root]["vartree"].dbapi
-
-"""Query active USE flags for current environment"""
-use = portage.settings["USE"].split()
+# portage is only loaded when it is first needed, so importing this
+# module (for eg. from the tests) does not load the whole tree
+tree = helpers.LazyPortage()
 
 def _exit(n):
     """
@@ -118,15 +113,16 @@ if __name__ == '__main__':
     # The package name provided may not be a valid cpv. So, use the
     # portage API to find the most appropriate match
     try:
-        token = db.xmatch("match-all", package)
-    except portage.exception.InvalidAtom as e:
+        token = tree.db.xmatch("match-all", package)
+    except tree.portage.exception.InvalidAtom as e:
         _err("Error: Invalid token name:", str(e).strip())
         _exit(1)
-    except portage.exception.AmbiguousPackageName as e:
+    except tree.portage.exception.AmbiguousPackageName as e:
         _err("Error: Ambiguous token: ", str(e).strip())
         _exit(1)
 
     append_log("Package:", package)
+    append_log("Loaded the portage tree in %.2fs" % tree.load_time)
 
     if token == []:
         _err("Error: No Package Found")
@@ -1,4 +1,7 @@
 import httplib
+# Shared with the solver services, copied next to this file in the
+# client image
+from startup import LazyPortage
 
 def internet_working():
     conn = httplib.HTTPConnection("www.google.com")
@@ -10,3 +13,4 @@ def internet_working():
             return False
     except:
         return False
+
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import re
+import select
+import sys
+import time
+
+STDOUT = "stdout"
+STDERR = "stderr"
+
+# emerge --autounmask-write changed the config files, so the build has
+# to be run again once they are committed
+AUTOUNMASK = re.compile(r'Autounmask changes|needs? updating|'
+                        r'(keyword|USE) changes')
+
+
+def pump(process, sinks):
+    """
+    Reads the stdout and stderr of process together, as lines come in
+    on either of them, and passes each line to every sink as
+    sink(stream, stamp, line), where stream is STDOUT or STDERR and
+    stamp the time it was read. Neither pipe can fill up and block the
+    process while the other one is being read. Returns the return code
+    of the process once both are closed.
+    """
+    streams = {}
+    for name, pipe in [(STDOUT, process.stdout), (STDERR, process.stderr)]:
+        if pipe is not None:
+            streams[pipe.fileno()] = [name, pipe, ""]
+
+    while streams:
+        ready, _, _ = select.select(list(streams), [], [])
+        for fd in ready:
+            name, pipe, rest = streams[fd]
+            data = os.read(fd, 65536)
+            stamp = time.time()
+            if not data:
+                # Closed, pass on what is left of the last line
+                if rest:
+                    feed(sinks, name, stamp, rest)
+                pipe.close()
+                del streams[fd]
+                continue
+            lines = (rest + data).split("\n")
+            streams[fd][2] = lines.pop()
+            for line in lines:
+                feed(sinks, name, stamp, line + "\n")
+    return process.wait()
+
+
+def feed(sinks, stream, stamp, line):
+    for sink in sinks:
+        sink(stream, stamp, line)
+
+
+class Console(object):
+    """
+    Prints lines to stdout cut to `width` characters, ending with
+    dots if they are longer than that
+    """
+    def __init__(self, width=80, out=sys.stdout):
+        self.width = width
+        self.out = out
+
+    def __call__(self, stream, stamp, line):
+        line = line.rstrip("\n")
+        if len(line) > self.width - 3:
+            line = line[:self.width - 3] + "..."
+        print(line, file=self.out)
+        self.out.flush()
+
+
+class LogFile(object):
+    """
+    Appends lines to a log file, kept open, each one tagged with the
+    time it was read (and stderr for the ones from stderr)
+    For eg. "[14:02:11] >>> Emerging (1 of 3) dev-libs/foo-1.0"
+    """
+    def __init__(self, path):
+        self.file = open(path, "a", 1)
+        os.chmod(path, 0o666)
+
+    def __call__(self, stream, stamp, line):
+        tag = time.strftime("%H:%M:%S", time.localtime(stamp))
+        if stream == STDERR:
+            tag += " " + STDERR
+        self.file.write("[%s] %s" % (tag, line))
+
+    def close(self):
+        self.file.close()
+
+
+class Detector(object):
+    """
+    Watches for lines matching a pattern, for eg. the ones emerge
+    prints when it wrote autounmask changes. Keeps the first one that
+    matched in `matched`.
+    """
+    def __init__(self, pattern=AUTOUNMASK):
+        self.pattern = pattern
+        self.matched = None
+
+    def __call__(self, stream, stamp, line):
+        if self.matched is None and self.pattern.search(line):
+            self.matched = line
@@ -3,81 +3,145 @@ import container
 import control
 import helpers
 import solver
-from satispy import Cnf
-
-
-def reduceCnf(cnf):
-    """
-    I just found a remarkably large bug in my
-    SAT solver and found an interesting solution.
-    Remove all b | -b
-    (-b | b) & (b | -a) & (-b | a) & (a | -a)
-    becomes 
-    (b | -a) & (-b | a)
-    Remove all (-e) & (-e)
-    (-e | a) & (-e | a) & (-e | a) & (-e | a)
-    becomes
-    (-e | a)
-    (-b | b | c) becomes nothing, not (c)
-    """
-    if type(cnf) is str:
-        return cnf
-
-    output = Cnf()
-    for x in cnf.dis:
-        dont_add = False
-        for y in x:
-            for z in x:
-                if z == -y:
-                    dont_add = True
-                    break
-            if dont_add: break
-        if dont_add: continue
-        if x not in output.dis:
-            output.dis.append(x)
+import covering
+import combos
+import solvecache
+import batch
+import benchmark
+import flowcontrol
+import workpool
+import threading
+import serverclient
+import metadata
+import startup
+import resolvecache
+import incremental
+import edgestore
+import pump
+import subprocess
+import StringIO
+import urllib2
+import socket
+import time
+import json
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import tempfile
+import shutil
+import os
+import re
+import sys
+import signal
+import pycosat
+import itertools
+import random
+
+# dependency.py reads the address of the server when it is imported
+os.environ.setdefault("ORCA_SERVER_SERVICE_HOST", "127.0.0.1")
+import dependency
+import resolver
+
+
+def evaluate(node, env):
+    """
+    Whether a parse tree of solver.parse holds for the flag values in
+    env, straight from what each kind of group means
+    """
+    kind = node[0]
+    if kind == 'flag':
+        return env[node[1]] == node[2]
+    if kind == 'if':
+        return env[node[1]] != node[2] or all(evaluate(k, env) for k in node[3])
+    values = [evaluate(k, env) for k in node[1]]
+    if kind == 'all':
+        return all(values)
+    if kind == 'any':
+        return any(values)
+    if kind == 'one':
+        return values.count(True) == 1
+    return values.count(True) <= 1
+
+
+def truthTable(eq, names=None):
+    """
+    Brute force all the solutions of a REQUIRED_USE string over the
+    given flag names (by default, the ones in it), as a set of sets of
+    signed names
+    """
+    tree = solver.parse(eq)
+    if names is None:
+        names = solver.node_flags(tree)
+    output = set()
+    for values in itertools.product([False, True], repeat=len(names)):
+        env = dict(zip(names, values))
+        if evaluate(tree, env):
+            output.add(frozenset(("" if env[k] else "-") + k for k in names))
     return output
 
 
+def encodingSolutions(encoder, names, method):
+    """
+    All the solutions of one of the group encoders of solver.py
+    applied to the variables in names
+    """
+    f = solver.Formula(names)
+    encoder(f, [f.var[k] for k in names], [], method)
+    return set(frozenset(f.translate(k))
+               for k in pycosat.itersolve(f.clauses, vars=f.nvars))
+
+
 class TestSolver(unittest.TestCase):
     """
     Test suite for boolean satisfiabiity
     problem solver
     """
-    def testGetToken(self):
-        self.assertEqual(solver.getToken("flag1 (abc cde)"), ("flag1", "(abc cde)"))
-        self.assertEqual(solver.getToken("(abc def (ghi jkl) (abc)) ^^ (abc)"),
-                ("(abc def (ghi jkl) (abc))", "^^ (abc)"))
-
-    def testSolveToken(self):
-        self.assertEqual([str(k) for k in solver.solveToken("a b c")], ['a', 'b c'])
-        self.assertEqual([str(k) for k in solver.solveToken("( a b ) b c")],
-                ['(a) & (b)', 'b c'])
-        self.assertEqual([str(k) for k in solver.solveToken("!a b c")],
-                ['-a', 'b c'])
-        self.assertEqual(
-                [str(reduceCnf(k)) for k in solver.solveToken("(^^ ( a b )) b c")],
-                ['(a | b) & (-a | -b)', 'b c'])
-
-    def testAllOr(self):
-        self.assertEqual(str(solver.all_or("(a b c)")), '(a | c | b)')
-        self.assertEqual(str(solver.all_or("(a (b c) d)")), '(a | b | d) & (a | c | d)')
-
-    def testAllXor(self):
-        self.assertEqual(str(reduceCnf(solver.all_xor("(a b)"))), '(a | b) & (-a | -b)')
-        self.assertEqual(str(reduceCnf(solver.all_xor("(a b c)"))), " ".join("""
-                (a | c | b) & (a | -b | -c) & (-a | -b) & (-a | -b | c) &
-                (-a | -b | -c) & (-b | -c) & (-a | -c) & (-a | -c | b)
-                """.split()))
-
-    def testAtMost(self):
-        self.assertEqual(str(reduceCnf(solver.at_most("(a b c)"))),
-                " ".join("""(a | -b | -c) & (-a | -b) & (-a | -b | -c) &
-                (-a | -b | c) & (-b | -c) & (-a | -c) & (-a | -c | b)""".split()))
-        self.assertEqual(str(reduceCnf(solver.at_most("(a (b c) d)"))),
-                " ".join("""
-                (a | -b | -c | -d) & (-a | -b | -c) & (-a | -b | -c | -d) &
-                (-a | -b | -c | d) & (-b | -c | -d) & (-a | -d) & (-a | b | -d) &
-                (-a | c | -d)""".split()))
+    def testTokenize(self):
+        self.assertEqual(solver.tokenize("!a? ( b ) ^^(c)"), [
+                    ('cond', '!a', 0), ('open', '(', 4), ('flag', 'b', 6), ('close', ')', 8),
+                    ('op', '^^', 10), ('open', '(', 12), ('flag', 'c', 13), ('close', ')', 14)])
+
+    def testParse(self):
+        self.assertEqual(solver.parse("a? ( ^^ ( b !c ) ) ( d )"),
+                ('all', [('if', 'a', True, [('one', [('flag', 'b', True), ('flag', 'c', False)])]),
+                         ('all', [('flag', 'd', True)])]))
+        for eq, position in [("a ( b", 2), ("a ) b", 2), ("|| a", 3), ("a? ", 0), ("a $", 2)]:
+            with self.assertRaises(solver.ParseError) as error:
+                solver.parse(eq)
+            self.assertEqual(error.exception.position, position)
+
+    def testParseGroups(self):
+        self.assertEqual(solver.parse("(abc def (ghi jkl) (abc)) ^^ (abc)"),
+                ('all', [('all', [('flag', 'abc', True), ('flag', 'def', True),
+                                  ('all', [('flag', 'ghi', True), ('flag', 'jkl', True)]),
+                                  ('all', [('flag', 'abc', True)])]),
+                         ('one', [('flag', 'abc', True)])]))
+        self.assertEqual(solver.parse("|| ( a !b ) ?? ( c ) d? e"),
+                ('all', [('any', [('flag', 'a', True), ('flag', 'b', False)]),
+                         ('most', [('flag', 'c', True)]),
+                         ('if', 'd', True, [('flag', 'e', True)])]))
+        self.assertEqual(solver.node_flags(solver.parse("a? ( !b c ) b")), ['a', 'b', 'c'])
+
+    def testTruthTable(self):
+        # The clauses of every kind of group give the same solutions
+        # as evaluating the parse tree directly
+        for eq in ["|| ( a b c )", "^^ ( a b c )", "?? ( a ( b c ) d )",
+                   "a? ( ^^ ( b c d ) ) || ( a e )", "!a? ( b ) ?? ( a b )",
+                   "^^ ( a b ) c? ( a ) !b? ( d e )", "a !b ^^ ( b c ) ?? ( c d )"]:
+            self.assertEqual(set(frozenset(k) for k in solver.main(eq)), truthTable(eq))
+
+    def testLinearEncodings(self):
+        for n in range(1, 6):
+            names = ["f" + str(k) for k in range(n)]
+            group = "( " + " ".join(names) + " )"
+            for method in ['pairwise', 'ladder']:
+                self.assertEqual(encodingSolutions(solver.exactly_one, names, method),
+                                 truthTable("^^ " + group))
+                self.assertEqual(encodingSolutions(solver.at_most_one, names, method),
+                                 truthTable("?? " + group))
+
+        # Ladder clauses grow linearly with the size of the group
+        f = solver.Formula(["f" + str(k) for k in range(100)])
+        solver.exactly_one(f, range(1, 101), [])
+        self.assertTrue(len(f.clauses) < 500)
 
     def testMain(self):
         self.assertEqual(solver.main("a b c"), [['b', 'c', 'a']])
@@ -86,6 +150,969 @@ class TestSolver(unittest.TestCase):
                     ['-b', 'c', '-a'], ['b', '-c', '-a'] ])
         self.assertEqual(solver.main("a !b ^^ (b c) ?? (c d)"), [['-d', '-b', 'c', 'a']])
 
+    def testItersolve(self):
+        solutions = solver.itersolve("?? ( a b c )")
+        self.assertEqual(next(solutions), solver.main("?? ( a b c )")[0])
+        self.assertEqual(len(list(solutions)), 3)
+        self.assertEqual(solver.main("?? ( a b c )", limit=2), solver.main("?? ( a b c )")[:2])
+        self.assertEqual(solver.main("a", limit=0), [])
+        self.assertEqual(solver.main("", limit=5), [[]])
+
+    def testMinMaxEnabled(self):
+        enabled = lambda soln: sum(1 for k in soln if k[0] != '-')
+        for eq in ["?? ( a b c )", "a? ( ^^ ( b c d ) ) || ( a e )",
+                   "^^ ( a b ) c? ( a ) !b? ( d e )", ""]:
+            counts = [enabled(k) for k in solver.main(eq)]
+            self.assertEqual(enabled(solver.min_enabled(eq)), min(counts))
+            self.assertEqual(enabled(solver.max_enabled(eq)), max(counts))
+        self.assertEqual(sorted(solver.min_enabled("|| ( a b ) !a? ( c )")), ['-b', '-c', 'a'])
+        self.assertEqual(solver.max_enabled("a !a"), None)
+
+    def testSample(self):
+        eq = "^^ ( a b c d e f ) g? ( a b )"
+        valid = set(frozenset(k) for k in solver.main(eq))
+        # Same seed, same samples
+        self.assertEqual(solver.sample(eq, 5, seed=3), solver.sample(eq, 5, seed=3))
+        # Both the exact and the hashing based sampler only return
+        # valid combinations, and reach all of them
+        for pivot in [solver.SAMPLE_PIVOT, 2]:
+            samples = [frozenset(k) for k in solver.sample(eq, 200, seed=1, pivot=pivot)]
+            self.assertEqual(len(samples), 200)
+            self.assertEqual(set(samples), valid)
+        self.assertEqual(solver.sample("a !a"), [])
+
+    def testDecompose(self):
+        f = solver.compile_cnf("^^ ( a b ) ?? ( c d ) e? ( f ) g !h? ( a )")
+        d = solver.decompose(f)
+        self.assertEqual(d.fixed, {f.var['g']: True})
+        self.assertEqual(sorted(sorted(g.flags) for g, gvars in d.components),
+                         [['a', 'b', 'h'], ['c', 'd'], ['e', 'f']])
+        self.assertEqual(d.count(), 3 * 3 * 3)
+        self.assertEqual(len(solver.main("^^ ( a b ) ?? ( c d ) e? ( f ) g !h? ( a )")), 27)
+        self.assertEqual(solver.decompose(solver.compile_cnf("a? ( b ) a !b")), None)
+
+    def testIterModels(self):
+        # The counter variables of at_most_k are not fixed by the flags
+        f = solver.Formula(["a", "b", "c", "d"])
+        solver.at_most_k(f, [1, 2, 3, 4], 2)
+        self.assertFalse(f.defined)
+        full = list(pycosat.itersolve(f.clauses, vars=f.nvars))
+        projected = [tuple(k[:4]) for k in solver.iter_models(f)]
+        self.assertEqual(len(projected), 11)
+        self.assertEqual(set(projected), set(tuple(k[:4]) for k in full))
+        self.assertTrue(len(full) > len(projected))
+        self.assertEqual(len(list(solver.itersolve("?? ( a b c )", project=True))), 4)
+
+    def testCount(self):
+        for eq in ["?? ( a b c )", "a? ( ^^ ( b c d ) ) || ( a e ) f", "|| ( ( a b ) ( c d ) )"]:
+            self.assertEqual(solver.count(eq), (len(solver.main(eq)), True))
+        self.assertEqual(solver.count("a? ( b )", "+c -d a"), (12, True))
+        self.assertEqual(solver.count("a !a", "b"), (0, True))
+        # 12 * 3^12 combinations, far too many to enumerate
+        eq = "^^ ( " + " ".join("p%d" % k for k in range(12)) + " ) " + \
+             " ".join("x%d? ( y%d )" % (k, k) for k in range(12))
+        self.assertEqual(solver.count(eq), (12 * 3 ** 12, True))
+
+        f = solver.compile_cnf("|| ( a b c d e f g h i j k )")
+        with self.assertRaises(solver.CountLimit):
+            solver.count_exact(f, budget=1)
+        estimate = solver.count_approx(f, random.Random(1))
+        self.assertTrue(1024 <= estimate <= 4096)
+
+    def testCompileCnf(self):
+        solutions = lambda eq: set(frozenset(k) for k in solver.main(eq))
+        # Flag names that are substrings of each other
+        self.assertEqual(solutions("foo !foo_bar"), set([frozenset(['foo', '-foo_bar'])]))
+        # Nested groups and negated conditionals
+        self.assertEqual(solutions("!a !a? ( ^^ ( b ( c d ) ) )"), set([
+                    frozenset(['-a', 'b', '-c', '-d']), frozenset(['-a', 'b', 'c', '-d']),
+                    frozenset(['-a', 'b', '-c', 'd']), frozenset(['-a', '-b', 'c', 'd']) ]))
+
+
+
+class TestCovering(unittest.TestCase):
+    """
+    Tests for the covering array generator
+    """
+    def testGenerate(self):
+        iuse, req_use = "+a b -c d e", "^^ ( a b c ) d? ( e )"
+        valid = set(frozenset(k) for k in solver.main(req_use))
+        flags = covering.iuse_flags(iuse)
+        for strength in [1, 2, 3]:
+            rows = covering.generate(iuse, req_use, strength, seed=1)
+            # Every row is valid, and every allowed tuple is covered
+            for row in rows:
+                self.assertTrue(frozenset(row) in valid)
+            for tup in itertools.combinations(flags, strength):
+                for signs in itertools.product(["", "-"], repeat=strength):
+                    lits = [s + k for s, k in zip(signs, tup)]
+                    if any(set(lits) <= k for k in valid):
+                        self.assertTrue(any(set(lits) <= set(k) for k in rows))
+
+        self.assertEqual(len(covering.generate("a b c d e f", "", 2, budget=3)), 3)
+        self.assertEqual(covering.generate("a", "a !a"), [])
+        self.assertEqual(covering.generate(iuse, req_use, seed=4),
+                         covering.generate(iuse, req_use, seed=4))
+
+    def testHyphenatedFlags(self):
+        self.assertEqual(covering.iuse_flags("+l10n_pt-BR -a b"), ["l10n_pt-BR", "a", "b"])
+        # A hyphen inside a flag name is part of the name
+        for row in covering.generate("+l10n_pt-BR a", "l10n_pt-BR? ( a )", 1, seed=1):
+            self.assertEqual(sorted(combos.abs_flag(k) for k in row), ["a", "l10n_pt-BR"])
+        for row in combos.get_use_combinations("+l10n_pt-BR a", "l10n_pt-BR? ( a )"):
+            self.assertEqual(sorted(combos.abs_flag(k) for k in row), ["a", "l10n_pt-BR"])
+
+    def testUnsatisfiable(self):
+        self.assertEqual(combos.get_use_combinations("a b", "a !a"), set())
+        self.assertEqual(list(combos.pick_combinations("a b", "a !a", 2)), [])
+
+
+class TestSolverCache(unittest.TestCase):
+    """
+    Tests for the memoization of solver results
+    """
+    def tearDown(self):
+        solver.cache = None
+
+    def testNormalize(self):
+        self.assertEqual(solvecache.normalize("^^(a  b)\n c? (d)"), "^^ ( a b ) c? ( d )")
+
+    def testMemoize(self):
+        expected = solver.main("?? ( a b )")
+        solver.cache = solvecache.SolverCache(size=2)
+        # Misses for both the solutions and the compiled formula
+        self.assertEqual(solver.main("?? ( a b )"), expected)
+        self.assertEqual(solver.main("??(a b)"), expected)
+        # Reuses the formula, and evicts the least recently used
+        # entry (all the solutions) to make room for the new one
+        self.assertEqual(solver.main("?? ( a b )", limit=1), expected[:1])
+        self.assertEqual(solver.cache.stats(),
+                         {'hits': 2, 'disk_hits': 0, 'misses': 3, 'entries': 2})
+        self.assertEqual(solver.min_enabled("a !a"), None)
+        self.assertEqual(solver.min_enabled("a !a"), None)
+        self.assertEqual(solver.cache.stats()['hits'], 3)
+
+    def testDisk(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            solver.cache = solvecache.SolverCache(path=path)
+            expected = solver.sample("^^ ( a b c )", 3, seed=5)
+            solver.cache = solvecache.SolverCache(path=path)
+            self.assertEqual(solver.sample("^^ ( a b c )", 3, seed=5), expected)
+            self.assertEqual(solver.cache.stats()['disk_hits'], 1)
+        finally:
+            os.remove(path)
+
+
+class TestBatch(unittest.TestCase):
+    """
+    Tests for the batch flag solver over the metadata cache
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "app-misc"))
+        for pf, req_use in [("foo-1.0", "^^ ( a b )"), ("foo-9999", ""), ("bar-2", "a ( b"),
+                            ("foo-9999-r1", ""), ("baz-19999", ""), ("qux-1.9999", "")]:
+            with open(os.path.join(self.root, "app-misc", pf), "w") as f:
+                f.write("IUSE=+a b c\nKEYWORDS=~amd64 x86\nREQUIRED_USE=%s\n" % req_use)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testWalkCache(self):
+        entries = list(batch.walk_cache(self.root))
+        # Only the live ebuilds are skipped
+        self.assertEqual([k[0] for k in entries], ["app-misc/bar-2", "app-misc/baz-19999",
+                                                   "app-misc/foo-1.0", "app-misc/qux-1.9999"])
+        self.assertEqual(batch.read_metadata(entries[2][1]),
+                {"IUSE": "+a b c", "KEYWORDS": "~amd64 x86", "REQUIRED_USE": "^^ ( a b )"})
+        self.assertEqual(list(batch.walk_cache(self.root, ["sys-apps"])), [])
+
+    def testSolveEntry(self):
+        path = os.path.join(self.root, "app-misc", "foo-1.0")
+        cpv, combos, error = batch.solve_entry(("app-misc/foo-1.0", path, 2, None))
+        self.assertEqual(error, None)
+        for combo in combos:
+            self.assertEqual(len([k for k in combo if k in ["a", "b"]]), 1)
+        path = os.path.join(self.root, "app-misc", "bar-2")
+        self.assertTrue(batch.solve_entry(("app-misc/bar-2", path, 0, None))[2].startswith("ParseError"))
+
+
+class TestBenchmark(unittest.TestCase):
+    """
+    Tests for the solver benchmark
+    """
+    def testCorpus(self):
+        corpus = benchmark.load_corpus()
+        self.assertTrue(len(corpus) >= 20)
+        for name, iuse, req_use in corpus:
+            solver.parse(req_use)
+
+    def testBenchEntry(self):
+        name, result = benchmark.bench_entry(("x", "a b c", "^^ ( a b ) c? ( a )", 1, 10))
+        self.assertEqual(name, "x")
+        self.assertEqual(result["solutions"], 3)
+        for phase in benchmark.PHASES:
+            self.assertTrue(result[phase] >= 0)
+
+
+class TestFlowControl(unittest.TestCase):
+    """
+    Tests for the rate limiting between discovery and the dep solver
+    """
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+    def testTokenBucket(self):
+        bucket = flowcontrol.TokenBucket(2, 3, self.clock, self.sleep)
+        self.assertEqual([bucket.acquire() for i in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.acquire(), 0.5)
+        self.now += 10
+        self.assertEqual([bucket.acquire() for i in range(4)], [0, 0, 0, 0.5])
+
+    def testBackpressure(self):
+        pressure = flowcontrol.Backpressure(4, 1, 3, self.sleep)
+        self.assertEqual(pressure.wait(None), 0)
+        pressure.update("5")
+        depths = [6, 4, None]
+        self.assertEqual(pressure.wait(lambda: depths.pop(0)), 6)
+        self.assertEqual(self.sleeps, [1, 2, 3])
+        self.assertFalse(pressure.saturated())
+
+    def testResourceGate(self):
+        free = [100]
+        gate = flowcontrol.ResourceGate(2, 60, 1, lambda: free[0], self.sleep)
+        # One job always runs, then only as many as cores and memory allow
+        free[0] = 10
+        self.assertEqual(gate.acquire(), 0)
+        self.assertFalse(gate.admit())
+        free[0] = 100
+        self.assertTrue(gate.admit())
+        self.assertFalse(gate.admit())
+        gate.release()
+        self.assertEqual(gate.running, 1)
+        self.assertTrue(flowcontrol.cpu_count() >= 1)
+
+
+class TestWorkPool(unittest.TestCase):
+    """
+    Tests for the worker pool of the discovery and dependency services
+    """
+    def testSubmit(self):
+        pool = workpool.WorkPool(1, 1)
+        gate = threading.Event()
+        ran = []
+        def job(name):
+            gate.wait()
+            ran.append(name)
+        self.assertEqual(pool.submit("a", job, "a"), workpool.QUEUED)
+        # Wait for the worker to take "a", so "b" is the one queued
+        while pool.status()["active"] == 0:
+            gate.wait(0.01)
+        self.assertEqual(pool.submit("b", job, "b"), workpool.QUEUED)
+        self.assertEqual(pool.submit("a", job, "a"), workpool.DUPLICATE)
+        self.assertEqual(pool.submit("c", job, "c"), workpool.FULL)
+        status = pool.status()
+        self.assertEqual((status["jobs"], status["queued"], status["active"]), (2, 1, 1))
+        gate.set()
+        pool.join()
+        self.assertEqual(ran, ["a", "b"])
+        self.assertEqual(pool.depth(), 0)
+        self.assertEqual(pool.submit("a", job, "a"), workpool.QUEUED)
+        pool.join()
+        status = pool.status()
+        self.assertEqual((status["done"], status["coalesced"], status["rejected"]), (3, 1, 1))
+
+    def testPriority(self):
+        pool = workpool.WorkPool(1, 4)
+        gate = threading.Event()
+        ran = []
+        def job(name):
+            gate.wait()
+            ran.append(name)
+        pool.submit("a", job, "a")
+        while pool.status()["active"] == 0:
+            gate.wait(0.01)
+        pool.submit("b", job, "b")
+        pool.submit("c", job, "c", priority=-1)
+        pool.submit("d", job, "d")
+        gate.set()
+        pool.join()
+        # Higher priority first, then in the order they came
+        self.assertEqual(ran, ["a", "c", "b", "d"])
+        recent = pool.status()["recent"]
+        self.assertEqual([(k["key"], k["priority"]) for k in recent],
+                         [("a", 0), ("c", -1), ("b", 0), ("d", 0)])
+        self.assertTrue(all(k["wait"] >= 0 and k["run"] >= 0 for k in recent))
+
+    def testPriorityGate(self):
+        # Two workers, but room for one job at a time: the second
+        # worker must not take "b" while "a" runs and "c" is coming
+        gate = flowcontrol.ResourceGate(1, 0, 0.01, lambda: None)
+        pool = workpool.WorkPool(2, 4, gate)
+        started = threading.Event()
+        go = threading.Event()
+        ran = []
+        def job(name):
+            started.set()
+            go.wait()
+            ran.append(name)
+        pool.submit("a", job, "a")
+        started.wait(5)
+        pool.submit("b", job, "b")
+        time.sleep(0.05)
+        pool.submit("c", job, "c", priority=-1)
+        go.set()
+        pool.join()
+        self.assertEqual(ran, ["a", "c", "b"])
+
+    def testRestartOnce(self):
+        pool = workpool.WorkPool(2, 16)
+        starts = []
+        start = pool.start
+        def counted():
+            starts.append(1)
+            time.sleep(0.05)
+            start()
+        pool.start = counted
+        # As if this process had just been forked: the first submits
+        # of many threads at once restart the pool only once
+        pool.pid = -1
+        go = threading.Event()
+        def submit(n):
+            go.wait()
+            pool.submit(n, lambda: None)
+        threads = [threading.Thread(target=submit, args=(k,)) for k in range(8)]
+        for t in threads:
+            t.start()
+        go.set()
+        for t in threads:
+            t.join()
+        pool.join()
+        self.assertEqual(len(starts), 1)
+        self.assertEqual(len(pool.threads), 2)
+        self.assertEqual(pool.status()["done"], 8)
+
+
+class StandInServer(BaseHTTPRequestHandler):
+    """
+    Stand-in for the /bulk endpoint of the server. Replies with 503
+    to the first `failures` requests, like a server that is restarting.
+    """
+    requests = []
+    failures = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        StandInServer.requests.append((self.path, json.loads(body)))
+        if StandInServer.failures > 0:
+            StandInServer.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        entry = json.loads(body)
+        reply = json.dumps({"combos": len(entry["combos"]), "edges": len(entry["edges"])})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestServerClient(unittest.TestCase):
+    """
+    Tests for the bulk submissions to the server
+    """
+    def setUp(self):
+        StandInServer.requests = []
+        StandInServer.failures = 0
+        self.httpd = HTTPServer(("127.0.0.1", 0), StandInServer)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        session = serverclient.make_session(backoff=0)
+        self.client = serverclient.ServerClient("127.0.0.1:%d" % self.httpd.server_port, session)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def testSubmit(self):
+        reply = self.client.submit("app-misc/foo-1.0", combos=[["a", "-b"], "-a b"])
+        self.assertEqual(reply, {"combos": 2, "edges": 0})
+        reply = self.client.submit("app-misc/foo-1.0", edges=["dev-libs/bar-2"])
+        self.assertEqual(reply, {"combos": 0, "edges": 1})
+        self.assertEqual(StandInServer.requests, [
+            ("/bulk", {"package": "app-misc/foo-1.0", "combos": ["a -b", "-a b"], "edges": []}),
+            ("/bulk", {"package": "app-misc/foo-1.0", "combos": [], "edges": ["dev-libs/bar-2"]})])
+
+    def testRetry(self):
+        StandInServer.failures = 2
+        reply = self.client.submit("app-misc/foo-1.0", combos=["a"])
+        self.assertEqual(reply, {"combos": 1, "edges": 0})
+        self.assertEqual(len(StandInServer.requests), 3)
+
+
+class TestMetadata(unittest.TestCase):
+    """
+    Tests for the metadata index over the md5-cache
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "md5-cache")
+        os.makedirs(os.path.join(self.root, "app-misc"))
+        os.makedirs(os.path.join(self.root, "dev-libs"))
+        self.write("app-misc/foo-1.0", "IUSE=+a b\nKEYWORDS=~amd64 x86\nREQUIRED_USE=^^ ( a b )\n")
+        self.write("dev-libs/bar-2", "KEYWORDS=amd64\n_md5_=abc\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, cpv, text):
+        with open(os.path.join(self.root, cpv), "w") as f:
+            f.write(text)
+
+    def testIndex(self):
+        path = os.path.join(self.tmp, "index", "metadata.idx")
+        index = metadata.MetadataIndex(path, self.root)
+        self.assertEqual(index.get(["dev-libs/bar-2", "app-misc/foo-1.0", "app-misc/baz-3"],
+                                   ["KEYWORDS", "IUSE"]),
+                         [["amd64", ""], ["~amd64 x86", "+a b"], None])
+        self.assertEqual(index.aux_get("app-misc/foo-1.0", ["REQUIRED_USE"]), ["^^ ( a b )"])
+        self.assertRaises(KeyError, index.aux_get, "app-misc/baz-3", ["IUSE"])
+        self.assertRaises(KeyError, index.get, ["app-misc/foo-1.0"], ["_md5_"])
+        self.assertEqual(index.get(["app-misc/baz-3"], ["IUSE"], lambda cpv, keys: ["x"]), [["x"]])
+        self.assertEqual(index.refresh(), None)
+
+        self.write("app-misc/foo-1.0", "IUSE=c\nKEYWORDS=amd64\n")
+        self.write("app-misc/baz-3", "IUSE=d\n")
+        os.remove(os.path.join(self.root, "dev-libs/bar-2"))
+        self.assertEqual(index.refresh(force=True), (1, 1, 1))
+
+        # A new process opens the index that is already on disk
+        index = metadata.MetadataIndex(path, self.root)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get(["app-misc/baz-3", "app-misc/foo-1.0", "dev-libs/bar-2"], ["IUSE"]),
+                         [["d"], ["c"], None])
+
+
+class PidServer(BaseHTTPRequestHandler):
+    """
+    Replies with the pid of the process serving the request
+    """
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(str(os.getpid()))
+
+    def log_message(self, *args):
+        pass
+
+
+# Start of the scripts run by runIsolated
+ISOLATED = """
+import os, sys, signal, time, urllib2, startup, workpool
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+class PidServer(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(str(os.getpid()))
+
+    def log_message(self, *args):
+        pass
+"""
+
+
+def runIsolated(script, timeout=30):
+    """
+    Runs a script in a python of its own, so that it forks without the
+    threads the other tests left running. Everything it starts is
+    killed after timeout seconds, so a deadlock fails the test instead
+    of hanging the run. Returns (return code, output).
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen([sys.executable, "-c", ISOLATED + script],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               env=env, preexec_fn=os.setsid)
+    def kill():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        out = process.communicate()[0]
+    finally:
+        timer.cancel()
+        # Children it forked and left behind too
+        kill()
+    return process.returncode, out
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Tests for the lazy loading and the pre-forked workers
+    """
+    def testTimer(self):
+        timer = startup.Timer()
+        timer.mark("imports")
+        timer.mark("portage")
+        report = timer.report()
+        self.assertEqual([k[0] for k in report["steps"]], ["imports", "portage"])
+        self.assertTrue(str(timer).startswith("imports "))
+
+    def testLazy(self):
+        # Nothing is loaded until portage is actually used
+        self.assertEqual(container.tree.module, None)
+        self.assertTrue(helpers.LazyPortage is startup.LazyPortage)
+        self.assertEqual(startup.LazyPortage().module, None)
+
+    def testWorkPoolFork(self):
+        code, out = runIsolated("""
+pool = workpool.WorkPool(1, 4)
+# The threads of the pool are running when it forks
+pool.submit("x", time.sleep, 0)
+pool.join()
+pid = os.fork()
+if pid == 0:
+    ran = []
+    pool.submit("a", ran.append, "a")
+    pool.join()
+    os._exit(0 if ran == ["a"] else 1)
+sys.exit(os.waitpid(pid, 0)[1] != 0)
+""")
+        self.assertEqual(code, 0, out)
+
+    def testPrefork(self):
+        code, out = runIsolated("""
+httpd = HTTPServer(("127.0.0.1", 0), PidServer)
+pid = os.fork()
+if pid == 0:
+    try:
+        startup.serve(httpd, 2)
+    finally:
+        os._exit(0)
+httpd.server_close()
+url = "http://127.0.0.1:%d/" % httpd.server_port
+workers = set(int(urllib2.urlopen(url, timeout=10).read()) for i in range(10))
+assert pid not in workers
+os.kill(pid, signal.SIGTERM)
+assert os.waitpid(pid, 0)[1] == 0
+for worker in workers:
+    try:
+        os.kill(worker, 0)
+        sys.exit("worker %d still running" % worker)
+    except OSError:
+        pass
+""")
+        self.assertEqual(code, 0, out)
+
+
+class TestFrontEnd(unittest.TestCase):
+    """
+    Tests for the threaded front end of the solvers and its shutdown
+    """
+    def testSlowClient(self):
+        httpd = startup.ThreadedHTTPServer(("127.0.0.1", 0), PidServer)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            # A client that never finishes its request does not hold
+            # up the next one
+            slow = socket.create_connection(("127.0.0.1", httpd.server_port))
+            slow.send("GET / HTTP/1.0\r\n")
+            url = "http://127.0.0.1:%d/" % httpd.server_port
+            self.assertEqual(urllib2.urlopen(url, timeout=5).read(), str(os.getpid()))
+            slow.send("\r\n")
+            self.assertTrue(slow.makefile().read().endswith(str(os.getpid())))
+            slow.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def testDrain(self):
+        pool = workpool.WorkPool(2, 4)
+        pool.submit("a", time.sleep, 0.2)
+        pool.submit("b", time.sleep, 5)
+        self.assertEqual(pool.drain(1), 1)
+        self.assertEqual(pool.submit("c", time.sleep, 0), workpool.FULL)
+        self.assertTrue(pool.status()["closed"])
+
+    def testGracefulShutdown(self):
+        code, out = runIsolated("""
+httpd = startup.ThreadedHTTPServer(("127.0.0.1", 0), PidServer)
+read, write = os.pipe()
+pid = os.fork()
+if pid == 0:
+    try:
+        os.close(read)
+        startup.serve(httpd, 0, lambda: os.write(write, "drained") and 0)
+    finally:
+        os._exit(0)
+os.close(write)
+httpd.server_close()
+url = "http://127.0.0.1:%d/" % httpd.server_port
+assert urllib2.urlopen(url, timeout=10).read() == str(pid)
+os.kill(pid, signal.SIGTERM)
+assert os.read(read, 100) == "drained"
+assert os.waitpid(pid, 0)[1] == 0
+""")
+        self.assertEqual(code, 0, out)
+
+    def testServiceHandler(self):
+        priorities = []
+
+        class Handler(startup.ServiceHandler):
+            pool = workpool.WorkPool(1, 4)
+
+            def handle_get(self):
+                priorities.append(self.priority())
+                self.reply(200, "Ok!")
+
+            def log_message(self, *args):
+                pass
+
+        httpd = startup.ThreadedHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_port
+            for priority in ["-1", "high", None]:
+                headers = {"X-Priority": priority} if priority else {}
+                r = urllib2.urlopen(urllib2.Request(url + "job", headers=headers), timeout=5)
+                self.assertEqual((r.read(), r.info()["X-Queue-Depth"]), ("Ok!", "0"))
+            # A malformed priority is the default one
+            self.assertEqual(priorities, [-1, 0, 0])
+            status = json.loads(urllib2.urlopen(url + "status", timeout=5).read())
+            self.assertEqual((status["workers"], "startup" in status), (1, True))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+class TestResolveCache(unittest.TestCase):
+    """
+    Tests for the cache of emerge --pretend results
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testNormalizeUse(self):
+        self.assertEqual(resolvecache.normalize_use("a b -a test c"), ["-a", "b", "c", "test"])
+        self.assertEqual(resolvecache.normalize_use("a -* +b"), ["-*", "b"])
+        self.assertEqual(resolvecache.normalize_use(" b  a "), resolvecache.normalize_use("a b"))
+
+    def testSnapshot(self):
+        os.mkdir(os.path.join(self.tmp, "metadata"))
+        with open(os.path.join(self.tmp, "metadata", "timestamp.chk"), "w") as f:
+            f.write("Sun, 14 Aug 2016 00:45:01 +0000\n")
+        self.assertEqual(resolvecache.tree_snapshot(self.tmp), "Sun, 14 Aug 2016 00:45:01 +0000")
+
+    def testPlans(self):
+        path = os.path.join(self.tmp, "plans.db")
+        plans = resolvecache.ResolutionCache(path)
+        plans.put("app-misc/foo-1.0", "a -b test", "s1", "/p", ["dev-libs/bar-2", "app-misc/foo-1.0"])
+        self.assertEqual(plans.get("app-misc/foo-1.0", "test -b a", "s1", "/p"),
+                         ["dev-libs/bar-2", "app-misc/foo-1.0"])
+        self.assertEqual(plans.get("app-misc/foo-1.0", "a b test", "s1", "/p"), None)
+        self.assertEqual(plans.get("app-misc/foo-1.0", "a -b test", "s2", "/p"), None)
+        self.assertEqual(plans.get("app-misc/foo-1.0", "a -b test", "s1", "/q"), None)
+
+        # Plans survive restarts, until the tree is synced
+        plans = resolvecache.ResolutionCache(path)
+        self.assertEqual(plans.get("app-misc/foo-1.0", "a -b test", "s1", "/p"),
+                         ["dev-libs/bar-2", "app-misc/foo-1.0"])
+        self.assertEqual(plans.prune("s2"), 1)
+        self.assertEqual(plans.stats(), {"hits": 1, "misses": 0, "entries": 0})
+
+
+class FakePackage(object):
+    """
+    Stand-in for the _emerge Package objects of a depgraph
+    """
+    def __init__(self, cpv, operation="merge", use=()):
+        self.cpv = cpv
+        self.version = cpv.split("-", 2)[-1]
+        self.slot = "0"
+        self.slot_atom = cpv.rsplit("-", 1)[0] + ":0"
+        self.operation = operation
+        self.use = type("Use", (), {"enabled": frozenset(use)})()
+
+
+class FakeVardb(object):
+    def __init__(self, installed):
+        self.installed = installed
+
+    def match(self, atom):
+        return [FakePackage(k) for k in self.installed if k.startswith(atom[:-2] + "-")]
+
+
+class FakeResolver(resolver.Resolver):
+    """
+    Resolver whose depgraph merges a fixed list of packages, or fails
+    """
+    def __init__(self, packages, installed=()):
+        resolver.Resolver.__init__(self, None)
+        self.packages = packages
+        self.vardb = FakeVardb(installed)
+        self.calls = []
+
+    def trees_for(self, use):
+        return {"EROOT": "/"}, {"/": {"vartree": type("Tree", (), {"dbapi": self.vardb})}}
+
+    def depgraph(self, settings, trees, atoms):
+        self.calls.append(atoms)
+        graph = type("Graph", (), {"altlist": lambda graph: self.packages})()
+        return self.packages is not None, graph
+
+
+def cmp_versions(a, b):
+    return cmp([int(k) for k in a.split(".")], [int(k) for k in b.split(".")])
+
+
+class TestResolver(unittest.TestCase):
+    """
+    Tests for the in-process resolution with portage's depgraph
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.resolver = dependency.resolver
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+
+    def tearDown(self):
+        dependency.resolver = self.resolver
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.tmp)
+
+    def quiet(self):
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+
+    def testReason(self):
+        vardb = FakeVardb(["dev-libs/bar-1.0"])
+        self.assertEqual(resolver.reason(FakePackage("dev-libs/foo-1.0"), vardb, cmp_versions), "new")
+        self.assertEqual(resolver.reason(FakePackage("dev-libs/bar-1.2"), vardb, cmp_versions), "update")
+        self.assertEqual(resolver.reason(FakePackage("dev-libs/bar-0.9"), vardb, cmp_versions), "downgrade")
+        self.assertEqual(resolver.reason(FakePackage("dev-libs/bar-1.0"), vardb, cmp_versions), "reinstall")
+
+    def testResolveAtoms(self):
+        packages = [FakePackage("dev-libs/bar-2", use=["ssl"]),
+                    FakePackage("dev-libs/old-1", "uninstall"),
+                    FakePackage("app-misc/foo-1.0")]
+        fake = FakeResolver(packages)
+        self.assertEqual(fake.resolve_atoms(["app-misc/foo"], "ssl"), [
+            {"cpv": "dev-libs/bar-2", "use": ["ssl"], "slot": "0", "reason": "new"},
+            {"cpv": "app-misc/foo-1.0", "use": [], "slot": "0", "reason": "new"}])
+        self.assertEqual(fake.resolve("app-misc/foo-1.0", ""), fake.resolve_atoms(["app-misc/foo"], ""))
+        self.assertEqual(fake.calls[1], ["=app-misc/foo-1.0"])
+        self.assertRaises(ValueError, FakeResolver(None).resolve, "app-misc/foo-1.0", "")
+
+    def testPretend(self):
+        # A stand-in emerge on the PATH of the environment it is run with
+        with open(os.path.join(self.tmp, "emerge"), "w") as f:
+            f.write("#!/bin/sh\necho '[ebuild  N     ] dev-libs/emerged-1'\n")
+        os.chmod(os.path.join(self.tmp, "emerge"), 0o755)
+        env = {"PATH": self.tmp + ":" + os.environ["PATH"], "USE": "a"}
+        self.quiet()
+
+        dependency.resolver = FakeResolver([FakePackage("dev-libs/bar-2")])
+        self.assertEqual(dependency.portage_pretend(["=app-misc/foo-1.0"], env),
+                         (["dev-libs/bar-2"], True))
+
+        # An unresolvable tree is a failed resolution
+        dependency.resolver = FakeResolver(None)
+        self.assertEqual(dependency.portage_pretend(["=app-misc/foo-1.0"], env), ([], False))
+
+        # Anything else falls back to running emerge
+        dependency.resolver = FakeResolver([FakePackage("dev-libs/bar-2")])
+        dependency.resolver.depgraph = lambda *args: 1 / 0
+        self.assertEqual(dependency.portage_pretend(["=app-misc/foo-1.0"], env), (None, False))
+        resolver_kind = dependency.RESOLVER
+        dependency.RESOLVER = "portage"
+        try:
+            self.assertEqual(dependency.pretend(["=app-misc/foo-1.0"], env),
+                             (["dev-libs/emerged-1"], True))
+        finally:
+            dependency.RESOLVER = resolver_kind
+
+
+class TestIncremental(unittest.TestCase):
+    """
+    Tests for resolving USE combinations from the dependencies they share
+    """
+    def testReduce(self):
+        depstr = "a/b ssl? ( c/d !gtk? ( e/f ) ) || ( g/h i/j ) x/y[ssl?,-doc]"
+        self.assertEqual(incremental.reduce_deps(depstr),
+                         ["a/b", (("g/h",), ("i/j",))])
+        self.assertEqual(incremental.reduce_deps(depstr, set(["ssl"])),
+                         ["a/b", "c/d", "e/f", (("g/h",), ("i/j",)), "x/y[ssl,-doc]"])
+        self.assertEqual(incremental.reduce_deps(depstr, set(["gtk"])),
+                         ["a/b", (("g/h",), ("i/j",)), "x/y[-doc]"])
+        # Choices that are groups, and || groups that depend on the flags
+        depstr = "!a/b || ( c/d ( e/f g/h ) ) || ( i/j ssl? ( k/l ) )"
+        self.assertEqual(incremental.reduce_deps(depstr),
+                         ["!a/b", (("c/d",), ("e/f", "g/h"))])
+        self.assertEqual(incremental.reduce_deps(depstr, set(["ssl"])),
+                         ["!a/b", (("c/d",), ("e/f", "g/h")), (("i/j",), ("k/l",))])
+        self.assertEqual(incremental.dep_string((("c/d",), ("e/f", (("g/h",), ("i/j",))))),
+                         "|| ( c/d ( e/f || ( g/h i/j ) ) )")
+        self.assertEqual(incremental.blocker_cp("!!<dev-libs/foo-2.1-r1:0[ssl]"), "dev-libs/foo")
+        self.assertEqual(incremental.blocker_cp("!dev-libs/foo-bar"), "dev-libs/foo-bar")
+        self.assertEqual(incremental.evaluate_use_deps("a/b[ssl=,!gtk=,!doc?]", set(["ssl"])),
+                         "a/b[ssl,gtk,-doc]")
+        self.assertRaises(ValueError, incremental.reduce_deps, "ssl? ( a/b")
+
+    def testPlan(self):
+        resolved = []
+
+        def resolve(atoms):
+            resolved.append(atoms)
+            return [k.split("[")[0] + "-1" for k in atoms], True
+
+        planner = incremental.Planner(resolve, resolvecache.ResolutionCache(),
+                                      lambda name: (name, "", "s1", "/p"))
+        depstrs = ["a/b ssl? ( c/d )", "doc? ( e/f )", ""]
+        self.assertEqual(planner.plan("app-misc/foo-1.0", depstrs, ["ssl", "-doc"]),
+                         (["a/b-1", "c/d-1", "app-misc/foo-1.0"], True))
+        self.assertEqual(planner.plan("app-misc/foo-1.0", depstrs, ["-ssl", "-doc"]),
+                         (["a/b-1", "app-misc/foo-1.0"], True))
+        self.assertEqual(planner.plan("app-misc/foo-1.0", depstrs, ["ssl", "doc"]),
+                         (["a/b-1", "c/d-1", "e/f-1", "app-misc/foo-1.0"], True))
+        # The shared part is only resolved once
+        self.assertEqual(resolved, [["a/b"], ["c/d"], ["c/d", "e/f"]])
+        # || groups are resolved choice by choice
+        self.assertEqual(planner.plan("app-misc/foo-1.0", ["ssl? ( || ( c/d e/f ) )"], ["ssl"]),
+                         (["c/d-1", "app-misc/foo-1.0"], True))
+
+    def testRealisticDepend(self):
+        # DEPEND of dev-libs/glib-2.80.5 (trimmed), with an unconditional
+        # || group and blockers
+        depend = """!<dev-util/gdbus-codegen-2.80.5 !<dev-libs/gobject-introspection-1.80.1
+            >=virtual/libiconv-0-r1 >=dev-libs/libpcre2-10.32:0[unicode(+),static-libs?]
+            >=dev-libs/libffi-3.0.13-r1:= >=sys-libs/zlib-1.2.8-r1
+            || ( >=dev-lang/python-3.12.0:3.12[xml(+)] >=dev-lang/python-3.11.0:3.11[xml(+)] )
+            dbus? ( sys-apps/dbus ) elf? ( virtual/libelf:0= )
+            introspection? ( >=dev-libs/gobject-introspection-common-1.80.1 )"""
+        cpv = "dev-libs/glib-2.80.5"
+        resolved = []
+        have = set([">=dev-lang/python-3.11.0:3.11[xml(+)]"])
+
+        def resolve(atoms):
+            resolved.append(atoms)
+            if ">=dev-lang/python-3.11.0:3.11[xml(+)]" in atoms:
+                return [], False
+            return [incremental.VERSION.sub("", re.sub(r'^[<>=~]+|[:\[].*$', '', k)) + "-9"
+                    for k in atoms], True
+
+        planner = incremental.Planner(resolve, resolvecache.ResolutionCache(),
+                                      lambda name: (name, "", "s1", "/p"),
+                                      lambda atom: atom in have)
+        deps, ok = planner.plan(cpv, [depend], ["dbus", "-elf", "-introspection"])
+        self.assertTrue(ok)
+        self.assertEqual(deps[-2:], ["sys-apps/dbus-9", cpv])
+        self.assertTrue("dev-lang/python-9" in deps)
+        # The installed python 3.11 was tried first, then 3.12, and
+        # blockers never go to emerge
+        self.assertEqual(len(resolved), 3)
+        self.assertTrue(">=dev-lang/python-3.11.0:3.11[xml(+)]" in resolved[0])
+        self.assertTrue(all(not k.startswith("!") for atoms in resolved for k in atoms))
+        # Another combination only resolves its delta (libpcre2 has a
+        # USE dependency on static-libs, so it is in every delta)
+        planner.plan(cpv, [depend], ["-dbus", "elf", "-introspection"])
+        self.assertEqual(len(resolved), 4)
+        self.assertEqual(resolved[-1], [">=dev-libs/libpcre2-10.32:0[unicode(+)]",
+                                        "virtual/libelf:0="])
+        # A package the blockers name in the merge list: resolve as a whole
+        blocking = "!sys-apps/dbus " + depend
+        self.assertEqual(planner.plan(cpv, [blocking], ["dbus", "-elf", "-introspection"]), None)
+
+
+class TestEdgeStore(unittest.TestCase):
+    """
+    Tests for the edges already sent to the server
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testEdges(self):
+        path = os.path.join(self.tmp, "edges")
+        seen = edgestore.EdgeStore(2, path)
+        self.assertEqual(seen.new("a/b-1", ["c/d-1", "e/f-1"]), ["c/d-1", "e/f-1"])
+        seen.add("a/b-1", ["c/d-1", "e/f-1"])
+        self.assertEqual(seen.new("a/b-1", ["c/d-1", "e/f-1", "g/h-1"]), ["g/h-1"])
+        self.assertEqual(seen.new("x/y-1", ["c/d-1"]), ["c/d-1"])
+
+        # Only the last ones are kept, and read back from the file
+        seen.add("x/y-1", ["c/d-1"])
+        seen = edgestore.EdgeStore(2, path)
+        self.assertEqual(seen.new("a/b-1", ["c/d-1", "e/f-1"]), ["c/d-1"])
+        self.assertEqual(seen.stats(), {"hits": 1, "misses": 1, "entries": 2})
+
+        # The file is compacted once it has twice as many edges
+        seen = edgestore.EdgeStore(1, path)
+        with open(path) as f:
+            self.assertEqual(f.read(), "x/y-1 c/d-1\n")
+
+
+class TestPump(unittest.TestCase):
+    """
+    Tests for streaming the output of emerge
+    """
+    def testPump(self):
+        lines = []
+        detector = pump.Detector()
+        # More on stderr than a pipe holds, while stdout is still open
+        script = ("echo one; head -c 200000 /dev/zero | tr '\\0' x >&2; echo >&2; "
+                  "echo 'The following USE changes are necessary'; printf last")
+        process = subprocess.Popen(["sh", "-c", script],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        code = pump.pump(process, [lambda *k: lines.append(k), detector])
+        self.assertEqual(code, 0)
+        self.assertEqual([(k[0], k[2]) for k in lines if k[0] == pump.STDOUT],
+                         [(pump.STDOUT, "one\n"),
+                          (pump.STDOUT, "The following USE changes are necessary\n"),
+                          (pump.STDOUT, "last")])
+        self.assertEqual([len(k[2]) for k in lines if k[0] == pump.STDERR], [200001])
+        self.assertEqual(detector.matched, "The following USE changes are necessary\n")
+
+    def testSinks(self):
+        out = StringIO.StringIO()
+        console = pump.Console(10, out)
+        console(pump.STDOUT, 0, "short\n")
+        console(pump.STDOUT, 0, "a much longer line\n")
+        self.assertEqual(out.getvalue(), "short\na much ...\n")
+
+        tmp = tempfile.mkdtemp()
+        try:
+            log = pump.LogFile(os.path.join(tmp, "emerge_logs"))
+            log(pump.STDERR, 0, "oops\n")
+            log.close()
+            with open(os.path.join(tmp, "emerge_logs")) as f:
+                self.assertTrue(f.read().endswith(" stderr] oops\n"))
+        finally:
+            shutil.rmtree(tmp)
 
 
 class TestContainer(unittest.TestCase):
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import solver
+import solvecache
+from combos import pick_combinations
+from metadata import MD5_CACHE, read_metadata
+
+# Live ebuilds, for eg. foo-9999 or foo-9999-r1 (but not foo-19999)
+LIVE = re.compile(r'-9999(-r\d+)?$')
+
+
+def walk_cache(root, categories=None):
+    """
+    Yields (cpv, path) for every ebuild in the md5-cache, or only for
+    the ones of the given categories. Live (9999) versions are
+    skipped, as they are never stabilized.
+    """
+    if not categories:
+        categories = sorted(os.listdir(root))
+    for category in categories:
+        folder = os.path.join(root, category)
+        if not os.path.isdir(folder):
+            continue
+        for pf in sorted(os.listdir(folder)):
+            if LIVE.search(pf):
+                continue
+            yield category + "/" + pf, os.path.join(folder, pf)
+
+
+def init_worker(cache_path):
+    """
+    Runs once in every worker process. Each worker keeps its own
+    memory cache, and they share the disk cache if there is one.
+    """
+    solver.cache = solvecache.SolverCache(path=cache_path)
+
+
+def solve_entry(task):
+    """
+    Computes the combinations of one ebuild (in a worker process).
+    Returns (cpv, combos, error), with combos as sorted lists of flags.
+    """
+    cpv, path, strength, budget = task
+    try:
+        metadata = read_metadata(path)
+        combos = pick_combinations(metadata.get("IUSE", ""),
+                                   metadata.get("REQUIRED_USE", ""),
+                                   strength, budget)
+        return cpv, [sorted(k) for k in combos], None
+    except Exception as e:
+        return cpv, None, "%s: %s" % (type(e).__name__, e)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Precompute the USE flag combinations of every ebuild "
+                    "in the portage metadata cache")
+    parser.add_argument("categories", nargs="*",
+                        help="only these categories (default: all of them)")
+    parser.add_argument("-r", "--root", default=MD5_CACHE,
+                        help="md5-cache directory (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="combos.jsonl",
+                        help="file to write the combinations to")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("-s", "--strength", type=int, default=0,
+                        help="covering array strength (0 for the default combos)")
+    parser.add_argument("-b", "--budget", type=int, default=0,
+                        help="most combinations per ebuild (0 for no limit)")
+    parser.add_argument("--cache", help="sqlite file for the solver cache")
+    args = parser.parse_args(argv)
+
+    tasks = ((cpv, path, args.strength, args.budget or None)
+             for cpv, path in walk_cache(args.root, args.categories))
+
+    start = time.time()
+    done, failed = 0, 0
+    pool = multiprocessing.Pool(args.jobs, init_worker, (args.cache,))
+
+    # One JSON object per line: {"package": cpv, "combos": ["a -b", ...]}
+    # which the server imports with /import-combos
+    with open(args.output, "w") as out:
+        for cpv, combos, error in pool.imap_unordered(solve_entry, tasks, 32):
+            if error is not None:
+                print("Failed", cpv, error, file=sys.stderr)
+                failed += 1
+                continue
+            out.write(json.dumps({"package": cpv,
+                                  "combos": [" ".join(k) for k in combos]}) + "\n")
+            done += 1
+            if done % 1000 == 0:
+                print("Done", done, "ebuilds in %.1fs" % (time.time() - start))
+                sys.stdout.flush()
+    pool.close()
+    pool.join()
+
+    print("Wrote combinations of", done, "ebuilds to", args.output,
+          "in %.1fs (%d failed)" % (time.time() - start, failed))
+    return 1 if failed and not done else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import pycosat
+import solver
+from combos import get_use_combinations
+
+# REQUIRED_USE strings of real ebuilds, plus a few pathological ones
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "bench_corpus.txt")
+
+# Phases timed for every ebuild, in the order they are printed
+PHASES = ["parse", "encode", "solve", "enumerate", "count", "combos"]
+
+
+def load_corpus(path=CORPUS):
+    """
+    Reads the benchmark corpus into a list of (name, iuse, req_use).
+    Lines are "name<TAB>IUSE<TAB>REQUIRED_USE", # starts a comment.
+    """
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            name, iuse, req_use = line.split("\t")
+            corpus.append((name, iuse, req_use))
+    return corpus
+
+
+def best_time(func, repeat):
+    """
+    Runs func `repeat` times and returns the fastest run in seconds
+    (the others only measure how busy the machine was)
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def max_rss():
+    """
+    Peak resident memory of this process so far, in KB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, OS X reports bytes
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def bench_entry(task):
+    """
+    Times every phase of the solver on one REQUIRED_USE string. Returns
+    (name, result), with the times in seconds and the memory the
+    process grew by in KB.
+    """
+    name, iuse, req_use, repeat, limit = task
+    solver.cache = None
+    random.seed(0)
+    rss = max_rss()
+
+    result = {}
+    result["parse"] = best_time(lambda: solver.parse(req_use), repeat)
+    # Encoding needs the tree, so time both and take the parse out
+    compile_time = best_time(lambda: solver.build_cnf(req_use, ()), repeat)
+    result["encode"] = max(compile_time - result["parse"], 0.0)
+
+    f = solver.build_cnf(req_use, ())
+    result["solve"] = best_time(lambda: pycosat.solve(f.clauses), repeat)
+    result["enumerate"] = best_time(lambda: solver.main(req_use, limit), repeat)
+    result["count"] = best_time(lambda: solver.count(req_use, iuse, 0), repeat)
+    result["combos"] = best_time(lambda: get_use_combinations(iuse, req_use),
+                                 repeat)
+
+    result["flags"] = len(f.flags)
+    result["vars"] = f.nvars
+    result["clauses"] = len(f.clauses)
+    result["solutions"] = len(solver.main(req_use, limit))
+    result["mem_kb"] = max_rss() - rss
+    return name, result
+
+
+def run(corpus, repeat=3, limit=1000, isolate=True):
+    """
+    Benchmarks every entry of the corpus. With isolate, each entry
+    runs in a fresh process, so the memory figures of one ebuild are
+    not hidden by the peak of an earlier one.
+    """
+    tasks = [(name, iuse, req_use, repeat, limit)
+             for name, iuse, req_use in corpus]
+    if not isolate:
+        return [bench_entry(k) for k in tasks]
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.map(bench_entry, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def totals(cases):
+    """
+    Sums the time of each phase over all the entries
+    """
+    return dict((phase, sum(k[phase] for k in cases.values()))
+                for phase in PHASES)
+
+
+def report(results, out=sys.stdout):
+    """
+    Prints a table with the times of every entry in ms
+    """
+    cases = results["cases"]
+    width = max([len(k) for k in cases] + [5])
+    print("%-*s" % (width, "ebuild") +
+          "".join("%11s" % k for k in PHASES) + "%9s" % "mem KB", file=out)
+    for name in sorted(cases):
+        print("%-*s" % (width, name) +
+              "".join("%11.2f" % (cases[name][k] * 1000) for k in PHASES) +
+              "%9d" % cases[name]["mem_kb"], file=out)
+    print("%-*s" % (width, "total") +
+          "".join("%11.2f" % (results["total"][k] * 1000) for k in PHASES),
+          file=out)
+
+
+def compare(old, new, out=sys.stdout):
+    """
+    Prints how the phases of `new` changed against an earlier run, as
+    new/old ratios (below 1 is faster). Entries that are only in one
+    of the runs are left out.
+    """
+    names = sorted(set(old["cases"]) & set(new["cases"]))
+    width = max([len(k) for k in names] + [5])
+    print("%-*s" % (width, "ebuild") + "".join("%11s" % k for k in PHASES),
+          file=out)
+    rows = [(name, old["cases"][name], new["cases"][name]) for name in names]
+    rows.append(("total", totals(dict((k, old["cases"][k]) for k in names)),
+                 totals(dict((k, new["cases"][k]) for k in names))))
+    for name, before, after in rows:
+        ratios = []
+        for phase in PHASES:
+            if before.get(phase):
+                ratios.append("%10.2fx" % (after[phase] / before[phase]))
+            else:
+                ratios.append("%11s" % "-")
+        print("%-*s" % (width, name) + "".join(ratios), file=out)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the USE flag solver on a corpus of "
+                    "REQUIRED_USE strings (runs without portage)")
+    parser.add_argument("-c", "--corpus", default=CORPUS,
+                        help="corpus file (default: %(default)s)")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="runs of each phase, the fastest is kept")
+    parser.add_argument("-l", "--limit", type=int, default=1000,
+                        help="most solutions to enumerate per ebuild")
+    parser.add_argument("-k", "--filter", default="",
+                        help="only the ebuilds whose name contains this")
+    parser.add_argument("-o", "--output",
+                        help="file to write the results to, as JSON")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="results of an earlier run to compare against")
+    parser.add_argument("--in-process", action="store_true",
+                        help="run every ebuild in this process (the "
+                             "memory figures are then only rough)")
+    args = parser.parse_args(argv)
+
+    corpus = [k for k in load_corpus(args.corpus) if args.filter in k[0]]
+    start = time.time()
+    cases = dict(run(corpus, args.repeat, args.limit, not args.in_process))
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "limit": args.limit,
+        "cases": cases,
+        "total": totals(cases),
+        "elapsed": time.time() - start,
+    }
+    report(results)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print()
+        compare(old, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import random
+import solver
+import covering
+
+
+def abs_flag(flag):
+    """
+    This functions returns the absolute value of the flag
+    """
+    if flag[0] == '-':
+        return flag[1:]
+    return flag
+
+
+def get_use_combinations(use_flags, req_use):
+    """
+    For given use flags and required use combination
+    It uses random methods to generate valid yet random
+    combinations of USE flags to build/test the package.
+    There are none if req_use cannot be satisfied.
+    """
+
+    # use_flags is a string by default
+    use_flags = [k.lstrip('+-') for k in use_flags.split()]
+
+    # List to store final generated USE flag combinations
+    final_combinations = []
+
+    # Absolute values of flags from the required use variable
+    req_flags = []
+
+    # Sat solver determines the valid combinations of req_use with
+    # the fewest and the most USE flags enabled
+    req_min = solver.min_enabled(req_use)
+    req_max = solver.max_enabled(req_use)
+    if req_min is None:
+        return set()
+
+    # Sat solver draws two random valid combinations of req_use
+    req_solns = solver.sample(req_use, 2)
+
+    # Fill in req_flags from any of the solutions([] in case of
+    # no req_use variable)
+    for signed_flag in req_min:
+        req_flags.append(abs_flag(signed_flag))
+
+    # use_flags are those that weren't in req_flags, thus both
+    # sets are now mutually exclusive
+    req_flags = set(req_flags)
+    use_flags = set(use_flags) - req_flags
+
+    # Combination number one: Minimum possible USE flags enabled
+    tmp_use = ["-" + k for k in use_flags] + req_min
+    final_combinations.append(tmp_use)
+
+    # Combination number two: Maximum possible USE flags enabled
+    tmp_use = [k for k in use_flags] + req_max
+    final_combinations.append(tmp_use)
+
+    # Combination number three: Random + Random
+    bias = random.randrange(0, 10)  # Number between 0 and 9
+    tmp_use = [("-" if random.randrange(0, 10) <=
+                bias else "") + k for k in use_flags]
+    tmp_use += req_solns[0]
+    final_combinations.append(tmp_use)
+
+    # Combination number three: Random + Random
+    bias = random.randrange(0, 10)  # Number between 0 and 9
+    tmp_use = [("-" if random.randrange(0, 10) <=
+                bias else "") + k for k in use_flags]
+    tmp_use += req_solns[1]
+    final_combinations.append(tmp_use)
+
+    # Remove repeated sets by using a set of sets
+    return set(frozenset(k) for k in final_combinations)
+
+
+def pick_combinations(use_flags, req_use, strength=0, budget=None):
+    """
+    Returns the USE flag combinations to build a package with. With
+    a strength, they are taken from a covering array of that
+    strength (at most `budget` of them), otherwise they are the
+    combinations of get_use_combinations.
+    """
+    if strength > 0:
+        return covering.generate(use_flags, req_use, strength, budget)
+    return get_use_combinations(use_flags, req_use)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import itertools
+import random
+import pycosat
+import solver
+
+
+def iuse_flags(iuse):
+    """
+    Returns the flag names of an IUSE string, without the
+    default markers. For eg. "+foo -bar baz" gives
+    ['foo', 'bar', 'baz']
+    """
+    return [k.lstrip('+-') for k in iuse.split()]
+
+
+def all_tuples(nflags, strength):
+    """
+    Returns the set of every t-tuple of flag values (as sorted tuples
+    of signed variable numbers) for the flags 1..nflags
+    """
+    tuples = set()
+    for flags in itertools.combinations(range(1, nflags + 1), strength):
+        for signs in itertools.product([1, -1], repeat=strength):
+            tuples.add(tuple(s * k for s, k in zip(signs, flags)))
+    return tuples
+
+
+def satisfiable(f, assigned):
+    """
+    Returns a solution of the Formula with the given literals fixed,
+    or None if there isn't one
+    """
+    soln = pycosat.solve(f.clauses + [[k] for k in assigned], vars=f.nvars)
+    return None if soln == "UNSAT" else soln
+
+
+def generate(iuse, req_use, strength=2, budget=None, seed=None):
+    """
+    Returns a small list of valid USE flag combinations (in the same
+    format as the solutions of solver.main) such that every valid
+    value of every `strength` flags of IUSE appears together in at
+    least one of the combinations. For eg. with strength 2, for
+    every two flags a, b each of (a, b), (a, -b), (-a, b), (-a, -b)
+    is built at least once, unless REQUIRED_USE forbids it.
+
+    At most `budget` combinations are returned (no limit if None).
+    Since every combination covers as much as it can, the first
+    combinations are the most valuable ones when the budget runs out.
+
+    Rows are built greedily (like AETG): start from an uncovered
+    tuple, then give each remaining flag the value that covers the
+    most uncovered tuples, as long as REQUIRED_USE can still be
+    satisfied. The same seed always gives the same combinations.
+    """
+    rng = random.Random(seed)
+    f = solver.compile_cnf(req_use, iuse_flags(iuse))
+    n = len(f.flags)
+    strength = min(strength, n)
+
+    if satisfiable(f, []) is None:
+        return []
+
+    uncovered = all_tuples(n, strength)
+    # For every literal, the uncovered tuples that contain it
+    index = dict((k, set()) for k in range(-n, n + 1) if k != 0)
+    for tup in uncovered:
+        for k in tup:
+            index[k].add(tup)
+
+    def cover(tup):
+        uncovered.discard(tup)
+        for k in tup:
+            index[k].discard(tup)
+
+    rows = []
+    while uncovered and (budget is None or len(rows) < budget):
+        seed_tuple = min(uncovered)
+        model = satisfiable(f, seed_tuple)
+        if model is None:
+            # REQUIRED_USE forbids this tuple, it can't be covered
+            cover(seed_tuple)
+            continue
+
+        assigned = set(seed_tuple)
+        order = [k for k in range(1, n + 1) if k not in assigned and -k not in assigned]
+        rng.shuffle(order)
+        for var in order:
+            # Number of tuples each value would cover, given the
+            # values picked so far
+            score = lambda lit: sum(1 for tup in index[lit]
+                                    if all(k == lit or k in assigned for k in tup))
+            lit = var if score(var) >= score(-var) else -var
+
+            # The last solution tells if the value is still possible
+            # without asking the solver again
+            if model[var - 1] != lit:
+                soln = satisfiable(f, list(assigned) + [lit])
+                if soln is None:
+                    lit = -lit
+                else:
+                    model = soln
+            assigned.add(lit)
+
+        row = model[:n]
+        for tup in list(uncovered):
+            if all(model[abs(k) - 1] == k for k in tup):
+                cover(tup)
+        rows.append(f.translate(row))
+    return rows
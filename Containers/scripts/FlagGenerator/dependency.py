@@ -1,31 +1,88 @@
 #!/usr/bin/env python2
-from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+from startup import timer, LazyPortage, ServiceHandler, run_service
 from base64 import urlsafe_b64decode as b64decode
 import os
 import re
 import sys
-import time
 import base64
-import thread
-import portage
-import requests
+import json
+import traceback
+import workpool
+from metadata import MetadataIndex, MD5_CACHE
+from serverclient import ServerClient
+from resolvecache import ResolutionCache, tree_snapshot, profile_of
+from resolver import Resolver
+from incremental import Planner, DEP_KEYS
+from edgestore import EdgeStore
+from flowcontrol import ResourceGate, cpu_count
 from subprocess import Popen, PIPE
 
 # sync_logs = sp.check_output(['emerge', '--sync'])
 
 SERVER_IP = os.environ['ORCA_SERVER_SERVICE_HOST']
 
-"""Save a reference to the portage tree"""
-try:
-    db = portage.db[portage.root]["porttree"].dbapi
-except KeyError:
-    db = portage.db[portage.root]["vartree"].dbapi
-
-"""Query active USE flags for current environment"""
-use = portage.settings["USE"].split()
+# portage is only loaded when it is first needed (or right before the
+# workers are forked), so importing this module stays fast
+tree = LazyPortage(timer)
 
 PORT_NUMBER = 80
 
+# Number of worker processes forked from the warm main process
+# (0 to serve from the main process itself)
+PREFORK = int(os.environ.get('ORCA_DEP_SOLVER_PREFORK', '0'))
+
+# Seconds to let the jobs in flight finish when shutting down
+DRAIN_TIMEOUT = float(os.environ.get('ORCA_DRAIN_TIMEOUT', '25'))
+
+# Indexed copy of the metadata cache, so that looking up ebuilds does
+# not go through portage one aux_get at a time. Rebuilt from the
+# md5-cache incrementally when the tree is synced.
+meta = MetadataIndex(
+    os.environ.get('ORCA_METADATA_INDEX', '/var/cache/orca/metadata.idx'),
+    os.environ.get('ORCA_MD5_CACHE', MD5_CACHE))
+
+# Results of emerge --pretend, for as long as the tree is not synced
+# (kept on disk in ORCA_RESOLVE_CACHE if set). Each plan is keyed by
+# the cpv, its USE flags, the tree snapshot and the profile.
+plans = ResolutionCache(os.environ.get('ORCA_RESOLVE_CACHE'))
+last_snapshot = None
+
+# How plans are computed: "emerge" runs emerge -pUuD for each of them,
+# "portage" drives portage's depgraph in this process (falling back to
+# emerge if that fails for any other reason than an unresolvable tree)
+RESOLVER = os.environ.get('ORCA_RESOLVER', 'emerge')
+resolver = Resolver(tree)
+
+# With ORCA_INCREMENTAL=1, the dependencies every USE combination of a
+# package shares are resolved once, and each combination only resolves
+# the atoms its flags add. The combination then only applies to the
+# package itself, not to its whole dependency tree.
+INCREMENTAL = os.environ.get('ORCA_INCREMENTAL', '0') == '1'
+
+# Edges already sent to the server (kept on disk in ORCA_EDGE_FILE if
+# set), so each one is looked up and sent once
+seen = EdgeStore(int(os.environ.get('ORCA_EDGE_CACHE_SIZE', '65536')),
+                 os.environ.get('ORCA_EDGE_FILE'))
+
+# Pooled keep-alive connection to the server, with timeouts and retries
+client = ServerClient(SERVER_IP)
+
+# An emerge -p takes a core and ORCA_EMERGE_JOB_MEMORY MB at its peak.
+# Only as many run at once as the cores (shared between the pre-forked
+# workers) and the free memory of the pod allow.
+gate = ResourceGate(
+    max(1, cpu_count() // max(1, PREFORK)),
+    int(os.environ.get('ORCA_EMERGE_JOB_MEMORY', '512')) * 1024)
+
+# At most ORCA_DEP_SOLVER_WORKERS (by default, as many as the gate may
+# let through) jobs are started at once, with up to
+# ORCA_DEP_SOLVER_QUEUE requests waiting, the ones of higher priority
+# first. The number of jobs in flight is sent back with every response
+# (and on /status), so discovery can hold off while emerge is saturated.
+pool = workpool.WorkPool(
+    int(os.environ.get('ORCA_DEP_SOLVER_WORKERS', str(gate.cores))),
+    int(os.environ.get('ORCA_DEP_SOLVER_QUEUE', '64')), gate)
+
 def b64pad(msg):
     return msg+(4-len(msg)%4 if len(msg)%4!=0 else 0)*"="
 
@@ -35,7 +92,11 @@ def b64encode(s):
     """
     return base64.urlsafe_b64encode(s).replace('=', '')
 
-def dep_resolve(cpv, combo):
+def resolve_env(combo):
+    """
+    The environment emerge is run with to build cpv with the USE
+    combination
+    """
     # Create a copy of the environment
     my_env = os.environ.copy()
 
@@ -50,22 +111,128 @@ def dep_resolve(cpv, combo):
     if "USE" in my_env:
         my_env["USE"] += " " + combo
     else:
-        my_env["USE"] = portage.settings["USE"] + " " + combo
+        my_env["USE"] = tree.settings["USE"] + " " + combo
     my_env["USE"] += " test "
+    return my_env
+
 
+def tree_state():
+    """
+    Returns the (snapshot, profile) of the portage tree. When the
+    snapshot changes (the tree was synced), the plans of the older
+    ones are dropped.
+    """
+    global last_snapshot
+    snapshot = tree_snapshot(tree.settings.get("PORTDIR", "/usr/portage"))
+    if snapshot != last_snapshot:
+        dropped = plans.prune(snapshot)
+        if last_snapshot is not None:
+            print "Tree was synced, dropped", dropped, "cached plans"
+        last_snapshot = snapshot
+    return snapshot, profile_of(tree.settings.get("PORTAGE_CONFIGROOT", "/"))
+
+
+def emerge_pretend(atoms, my_env):
+    """
+    Runs emerge -pUuD for the atoms, for eg. ["=app-misc/foo-1.0"].
+    Returns (deps, ok), with ok False if emerge failed.
+    """
     # Let portage solve the build tree to find the best compatible
     # dependencies (highest possible version)
-    args = ['emerge', '-pUuD', "=" + cpv]
+    args = ['emerge', '-pUuD'] + list(atoms)
     process = Popen(args, env=my_env, stdout=PIPE, stderr=PIPE)
+    # communicate() reads stderr too, so emerge never blocks on it
+    out, err = process.communicate()
     deps = []
-    for line in process.stdout:
+    for line in out.splitlines():
         line = line.decode(encoding='UTF-8')
 
         # Retrieve the lines that show dependencies present
         # and append the required token to the dependency list
         dep = re.findall('^\[ebuild.*?\]\s*?([^\s]+)', line)
         if dep:
-            deps.append(dep[0])
+            deps.append(str(dep[0]))
+    return deps, process.returncode == 0
+
+
+def portage_pretend(atoms, my_env):
+    """
+    Same as emerge_pretend, through the depgraph of the portage loaded
+    in this process. Returns (None, False) if that did not work, so
+    emerge can be run instead.
+    """
+    try:
+        merge = resolver.resolve_atoms(atoms, my_env["USE"])
+        return [k["cpv"] for k in merge], True
+    except ValueError as e:
+        print "Could not resolve", " ".join(atoms), ":", e
+        return [], False
+    except Exception:
+        print "In-process resolution of", " ".join(atoms), "failed, running emerge"
+        traceback.print_exc()
+        return None, False
+
+
+def pretend(atoms, my_env):
+    """
+    Resolves the atoms with the configured resolver. Returns (deps, ok).
+    """
+    deps = None
+    if RESOLVER == "portage":
+        deps, ok = portage_pretend(atoms, my_env)
+    if deps is None:
+        deps, ok = emerge_pretend(atoms, my_env)
+    return deps, ok
+
+
+def installed(atom):
+    """
+    Whether a package matching atom is installed, so the choice of a
+    || group that has it is tried first
+    """
+    vardb = tree.portage.db[tree.portage.root]["vartree"].dbapi
+    try:
+        return bool(vardb.match(atom))
+    except tree.portage.exception.InvalidAtom:
+        return False
+
+
+def incremental_pretend(cpv, combo, snapshot, profile):
+    """
+    Resolves cpv with the USE combination from the shared dependencies
+    of the package and the ones the combination adds, each of them
+    resolved (and cached) once. Returns (None, False) if the package
+    has to be resolved as a whole, for eg. when one of its blockers
+    names a package of the merge list.
+    """
+    my_env = resolve_env("")
+    depstrs = meta.get([cpv], DEP_KEYS, tree.aux_get)[0]
+    planner = Planner(lambda atoms: pretend(atoms, my_env), plans,
+                      lambda name: (name, my_env["USE"], snapshot, profile),
+                      installed)
+    result = planner.plan(cpv, depstrs, combo.split())
+    if result is None:
+        return None, False
+    return result
+
+
+def dep_resolve(cpv, combo):
+    my_env = resolve_env(combo)
+
+    # Same package, flags, tree and profile give the same plan
+    snapshot, profile = tree_state()
+    deps = plans.get(cpv, my_env["USE"], snapshot, profile)
+    if deps is not None:
+        return (deps, my_env)
+
+    if INCREMENTAL:
+        deps, ok = incremental_pretend(cpv, combo, snapshot, profile)
+    if deps is None:
+        deps, ok = pretend(["=" + cpv], my_env)
+
+    # A failed resolution (for eg. blockers) is tried again next time
+    if ok:
+        plans.put(cpv, my_env["USE"], snapshot, profile, deps)
     return (deps, my_env)
 
 
@@ -73,48 +240,99 @@ def build_pretend(cpv, flags):
     ret_deps, my_env = dep_resolve(cpv, flags)
     deps = [k for k in ret_deps if k != cpv]
 
-    for dep_cpv in deps:
-        keywords = db.aux_get(dep_cpv, ["KEYWORDS"])[0].split()
+    # Edges sent for another combination (or an earlier trigger) need
+    # neither a lookup nor to be sent again
+    deps = seen.new(cpv, deps)
+
+    # Keywords of all the dependencies, in one lookup
+    metadata = meta.get(deps, ["KEYWORDS"], tree.aux_get)
+
+    edges = []
+    for dep_cpv, values in zip(deps, metadata):
+        keywords = values[0].split()
 
         # Check if the current status of the package is '~amd64' (Untested)
         if '~amd64' in keywords and dep_cpv != cpv:
-            payload = {
-                'parent'    : b64encode(cpv),
-                'dependency': b64encode(dep_cpv)
-            }
-
-            # Check what the server has to say about the package.
-            # The parent has to be sent too in case the package has
-            # been marked "fake - stabilized"
-            response = requests.get("http://"+SERVER_IP+"/sched-dep", params=payload)
-            print "Link from", cpv, "->", dep_cpv, "sent to server"
-            assert response.status_code == 200
-            sys.stdout.flush()
+            edges.append(dep_cpv)
         else:
             print("Dependency", dep_cpv, "is already stable")
             sys.stdout.flush()
 
+    # Send every link to the server at once. The server checks each of
+    # them against the tree, in case the dependency has been marked
+    # "fake - stabilized"
+    if edges:
+        reply = client.submit(cpv, edges=edges)
+        print "Links from", cpv, "->", edges, "sent to server,", reply["edges"], "new"
+        sys.stdout.flush()
+    # Stable dependencies are remembered too, they are only checked once
+    seen.add(cpv, deps)
+
+
+class myHandler(ServiceHandler):
+    pool = pool
+
+    def status(self):
+        status = ServiceHandler.status(self)
+        status["plans"] = plans.stats()
+        status["edges"] = seen.stats()
+        # Workers hold their place in the gate while they wait for a
+        # job too, so this is the number of places taken
+        status["gate"] = {"cores": gate.cores, "held": gate.running,
+                          "job_memory": gate.job_memory}
+        return status
+
+    def send_plan(self, path):
+        """
+        Replies with the cached plan of /plan/<base64 of cpv;combo>, so
+        the merge list of a combination can be looked up without running
+        emerge -p again
+        """
+        cpv, flags = b64decode(b64pad(path)).split(";")
+        snapshot, profile = tree_state()
+        deps = plans.get(cpv, resolve_env(flags)["USE"], snapshot, profile)
+        if deps is None:
+            self.reply(404, "No plan")
+            return
+        self.reply(200, json.dumps({"package": cpv, "flags": flags,
+                                    "snapshot": snapshot, "profile": profile,
+                                    "deps": deps}), 'application/json')
 
-class myHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type','text/html')
-        self.end_headers()
+    def handle_get(self):
+        if self.path.startswith("/plan/"):
+            self.send_plan(self.path[len("/plan/"):])
+            return
         path = b64pad(self.path[1:])
         cpv, flags = b64decode(path).split(";")
-        print "Dependency got request for", cpv, flags
+        priority = self.priority()
+        print "Dependency got request for", cpv, flags, "with priority", priority
         sys.stdout.flush()
-        thread.start_new_thread(build_pretend, (cpv, flags))
-        self.wfile.write("Ok!")
+
+        # The same combination of a package is only resolved once at a
+        # time, however many times it is asked for
+        key = (cpv, " ".join(sorted(flags.split())))
+        if pool.submit(key, build_pretend, cpv, flags,
+                       priority=priority) == workpool.FULL:
+            print "Queue is full, turning down", cpv, flags
+            self.reply(503, "Busy")
+            return
+        self.reply(200, "Ok!")
         return
-try:
-    print 'Starting httpserver on port ', PORT_NUMBER
-    sys.stdout.flush()
-    server = HTTPServer(('', PORT_NUMBER), myHandler)
-    print 'Started httpserver on port ' , PORT_NUMBER
-    sys.stdout.flush()
-    server.serve_forever()
-except KeyboardInterrupt:
-    print '^C received, shutting down the web server'
-    sys.stdout.flush()
-    server.socket.close()
+
+
+def load():
+    tree.load()
+    meta.current()
+    timer.mark("metadata")
+    if RESOLVER == "portage":
+        resolver.load()
+        timer.mark("emerge config")
+
+
+def main():
+    run_service(myHandler, PORT_NUMBER, PREFORK,
+                lambda: pool.drain(DRAIN_TIMEOUT), load)
+
+
+if __name__ == "__main__":
+    main()
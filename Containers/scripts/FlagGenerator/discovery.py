@@ -1,156 +1,191 @@
 #!/usr/bin/env python2
-from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+from startup import timer, LazyPortage, ServiceHandler, run_service
 from base64 import urlsafe_b64decode as b64decode
 import os
-import re
-import sys
-import thread
 import requests
-import random
 import base64
 import solver
-import time
-import portage
-import subprocess as sp
+from combos import pick_combinations
+import solvecache
+import workpool
+from metadata import MetadataIndex, MD5_CACHE
+from serverclient import ServerClient, make_session
+from flowcontrol import TokenBucket, Backpressure
 
 # sync_logs = sp.check_output(['emerge', '--sync'])
-"""Save a reference to the portage tree"""
-try:
-    db = portage.db[portage.root]["porttree"].dbapi
-except KeyError:
-    db = portage.db[portage.root]["vartree"].dbapi
 
-"""Query active USE flags for current environment"""
-use = portage.settings["USE"].split()
+# portage is only loaded when it is first needed (or right before the
+# workers are forked), so importing this module stays fast
+tree = LazyPortage(timer)
 
 SERVER_IP = os.environ['ORCA_SERVER_SERVICE_HOST']
 DEP_SOLVER_IP = os.environ['ORCA_DEP_SOLVER_SERVICE_HOST']
 
 PORT_NUMBER = 80
 
-
-def abs_flag(flag):
+# Number of worker processes forked from the warm main process
+# (0 to serve from the main process itself)
+PREFORK = int(os.environ.get('ORCA_DISCOVERY_PREFORK', '0'))
+
+# Seconds to let the jobs in flight finish when shutting down
+DRAIN_TIMEOUT = float(os.environ.get('ORCA_DRAIN_TIMEOUT', '25'))
+
+# Indexed copy of the metadata cache, so that looking up ebuilds does
+# not go through portage one aux_get at a time. Rebuilt from the
+# md5-cache incrementally when the tree is synced.
+meta = MetadataIndex(
+    os.environ.get('ORCA_METADATA_INDEX', '/var/cache/orca/metadata.idx'),
+    os.environ.get('ORCA_MD5_CACHE', MD5_CACHE))
+
+# Strength of the covering array the combinations to build are picked
+# from (0 to use the min/max/random combinations instead), and the
+# largest number of combinations to build for one package (0 for no
+# limit). Higher strength means better coverage, but more builds.
+COVERING_STRENGTH = int(os.environ.get('ORCA_COVERING_STRENGTH', '0'))
+COVERING_BUDGET = int(os.environ.get('ORCA_COVERING_BUDGET', '0')) or None
+
+# With ORCA_COUNT_COMBINATIONS=1, the number of valid combinations of
+# each package is counted and logged next to the number built. Counting
+# can take long on large REQUIRED_USE, so it is off by default.
+COUNT_COMBINATIONS = os.environ.get('ORCA_COUNT_COMBINATIONS', '0') == '1'
+
+# Many ebuilds share the same REQUIRED_USE, so keep the compiled
+# formulas and solutions around (on disk too, if a path is given)
+solver.cache = solvecache.SolverCache(
+    size=int(os.environ.get('ORCA_SOLVER_CACHE_SIZE', '1024')),
+    path=os.environ.get('ORCA_SOLVER_CACHE'))
+
+# Flow control towards the dep solver: combinations are sent at most
+# ORCA_DEP_SOLVER_RATE per second (with bursts of ORCA_DEP_SOLVER_BURST),
+# and not at all while it has ORCA_DEP_SOLVER_MAX_JOBS or more running.
+# The rate and burst are for discovery as a whole. Each pre-forked
+# worker has a bucket of its own, so each gets its share of them. The
+# running jobs are the ones the dep solver reports, so every worker
+# holds back on the same limit.
+WORKERS = max(1, PREFORK)
+dep_bucket = TokenBucket(
+    float(os.environ.get('ORCA_DEP_SOLVER_RATE', '1')) / WORKERS,
+    max(1, int(os.environ.get('ORCA_DEP_SOLVER_BURST', '4')) // WORKERS))
+dep_pressure = Backpressure(
+    int(os.environ.get('ORCA_DEP_SOLVER_MAX_JOBS', '8')))
+
+# Packages are split up by ORCA_DISCOVERY_WORKERS threads, with at most
+# ORCA_DISCOVERY_QUEUE packages waiting for one
+pool = workpool.WorkPool(
+    int(os.environ.get('ORCA_DISCOVERY_WORKERS', '4')),
+    int(os.environ.get('ORCA_DISCOVERY_QUEUE', '256')))
+
+
+# Pooled keep-alive connections with timeouts and retries. The dep
+# solver's 503s are not retried here, they go through dep_pressure.
+client = ServerClient(SERVER_IP)
+dep_session = make_session(status_forcelist=())
+
+
+def dep_solver_depth():
     """
-    This functions returns the absolute value of the flag
+    Asks the dep solver how many jobs it has running (None if it
+    could not be reached)
     """
-    if flag[0] == '-':
-        return flag[1:]
-    return flag
+    try:
+        r = dep_session.get("http://"+DEP_SOLVER_IP+"/status", timeout=10)
+        return r.json()["jobs"]
+    except (requests.RequestException, ValueError, KeyError):
+        return None
 
 
-def split_up(cpv):
+def split_up(cpv, priority=0):
     """
-    Output the details for the rest of the containers
+    Output the details for the rest of the containers. The dependency
+    solver is asked to resolve them with the priority of the package.
     """
 
-    # Retrieve the USE and REQUIRED_USE flags from the portage API
-    use_flags, req_use = db.aux_get(cpv, ["IUSE", "REQUIRED_USE"])
+    # Retrieve the USE and REQUIRED_USE flags from the metadata index
+    use_flags, req_use = meta.get([cpv], ["IUSE", "REQUIRED_USE"],
+                                  tree.aux_get)[0]
 
     # Returns a few valid USE flag combinations to test the build
-    combos = get_use_combinations(use_flags, req_use)
+    try:
+        combos = pick_combinations(use_flags, req_use,
+                                   COVERING_STRENGTH, COVERING_BUDGET)
+    except solver.ParseError as e:
+        print "Could not parse REQUIRED_USE of", cpv, ":", e
+        return
     combos = list(combos)
     total = len(combos)
+    if not combos:
+        print "No valid USE combination of", cpv, "for", repr(req_use)
+        return
+    print "Solver cache:", solver.cache.stats()
+
+    # Log how much of the valid USE flag space is being covered
+    if COUNT_COMBINATIONS:
+        space, exact = solver.count(req_use, use_flags)
+        print "Building %d of %s%d valid combinations of %s" % (
+            total, "" if exact else "about ", space, cpv)
+    else:
+        print "Building %d combinations of %s" % (total, cpv)
+
+    # All the combinations go to the server in one request
+    reply = client.submit(cpv, combos=combos)
+    print "Server added", reply["combos"], "combinations of", cpv
 
     for i in range(total):
         combo = list(combos[i])
         url = cpv + ";" + " ".join(combo)
-        payload = {'package': cpv, 'flags': " ".join(combo)}
 
         print "Sending a request to dep solver for", url
-        r = requests.get("http://"+SERVER_IP+"/add-combo", params=payload)
-        assert r.text == "1"
-
-        print "Sent a request to dep solver for", url
         encodedURL = "http://"+DEP_SOLVER_IP+"/" + base64.b64encode(url)
-        r2 = requests.get(encodedURL)
-
-        print "Going to sleep to prevent overload"
-        time.sleep(60)
+        while True:
+            # Wait for the dep solver to have room for another job
+            waited = dep_pressure.wait(dep_solver_depth)
+            waited += dep_bucket.acquire()
+            if waited >= 1:
+                print "Waited %.1fs for the dep solver" % waited
+
+            r2 = dep_session.get(encodedURL, timeout=client.timeout,
+                                 headers={"X-Priority": str(priority)})
+            dep_pressure.update(r2.headers.get("X-Queue-Depth"))
+            # 503 means its queue is full, so back off and send again
+            if r2.status_code != 503:
+                break
+            dep_pressure.update(dep_pressure.limit)
         assert r2.text == "Ok!"
+        print "Sent a request to dep solver for", url
     
 
-def get_use_combinations(use_flags, req_use):
-    """
-    For given use flags and required use combination
-    It uses random methods to generate valid yet random
-    combinations of USE flags to build/test the package
-    """
-
-    # use_flags is a string by default
-    use_flags = [k.replace('-', '').replace('+', '') for k in use_flags.split()]
-
-    # List to store final generated USE flag combinations
-    final_combinations = []
-
-    # Absolute values of flags from the required use variable
-    req_flags = []
-
-    # Sat solver determines all valid combinations of req_use
-    req_solns = solver.main(req_use)
-
-    # Fill in req_flags from any of the solutions([] in case of
-    # no req_use variable)
-    for signed_flag in req_solns[0]:
-        req_flags.append(abs_flag(signed_flag))
-
-    # Sort all cmbinations on the number of enabled USE flags
-    for i, soln in enumerate(req_solns):
-        req_solns[i] = (sum(1 for k in soln if k[0] != '-'), soln)
-    req_solns.sort(key=lambda tup: tup[0])
+def b64pad(msg):
+    return msg+(4-len(msg)%4 if len(msg)%4!=0 else 0)*"="
 
-    # use_flags are those that weren't in req_flags, thus both
-    # sets are now mutually exclusive
-    req_flags = set(req_flags)
-    use_flags = set(use_flags) - req_flags
+class myHandler(ServiceHandler):
+    pool = pool
 
-    # Combination number one: Minimum possible USE flags enabled
-    tmp_use = ["-" + k for k in use_flags] + req_solns[0][1]
-    final_combinations.append(tmp_use)
+    def handle_get(self):
+        path = b64pad(self.path[1:])
+        cpv = b64decode(path)
+        print "Discovery got a request for finding flags of", cpv
+        priority = self.priority()
+
+        # A package that is already being split up is not queued again
+        if pool.submit(cpv, split_up, cpv, priority,
+                       priority=priority) == workpool.FULL:
+            print "Queue is full, turning down", cpv
+            self.reply(503, "Busy")
+            return
+        self.reply(200, "Ok!")
+        return
 
-    # Combination number two: Maximum possible USE flags enabled
-    tmp_use = [k for k in use_flags] + req_solns[-1][1]
-    final_combinations.append(tmp_use)
 
-    # Combination number three: Random + Random
-    bias = random.randrange(0, 10)  # Number between 0 and 9
-    tmp_use = [("-" if random.randrange(0, 10) <=
-                bias else "") + k for k in use_flags]
-    tmp_use += req_solns[random.randrange(0, len(req_solns))][1]
-    final_combinations.append(tmp_use)
+def load():
+    tree.load()
+    meta.current()
+    timer.mark("metadata")
 
-    # Combination number three: Random + Random
-    bias = random.randrange(0, 10)  # Number between 0 and 9
-    tmp_use = [("-" if random.randrange(0, 10) <=
-                bias else "") + k for k in use_flags]
-    tmp_use += req_solns[random.randrange(0, len(req_solns))][1]
-    final_combinations.append(tmp_use)
 
-    # Remove repeated sets by using a set of sets
-    return set(frozenset(k) for k in final_combinations)
+def main():
+    run_service(myHandler, PORT_NUMBER, PREFORK,
+                lambda: pool.drain(DRAIN_TIMEOUT), load)
 
-def b64pad(msg):
-    return msg+(4-len(msg)%4 if len(msg)%4!=0 else 0)*"="
 
-class myHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type','text/html')
-        self.end_headers()
-        path = b64pad(self.path[1:])
-        cpv = b64decode(path)
-        print "Discovery got a request for finding flags of", cpv
-        thread.start_new_thread(split_up,(cpv,))
-        self.wfile.write("Ok!")
-        return
-try:
-    i = PORT_NUMBER
-    print ('Starting httpserver on port ' + str(i))
-    sys.stdout.flush()
-    server = HTTPServer(('', i), myHandler)
-    print ('Started httpserver on port ' + str(i))
-    sys.stdout.flush()
-    server.serve_forever()
-except KeyboardInterrupt:
-    print ('^C received, shutting down the web server')
-    sys.stdout.flush()
-    server.socket.close()
+if __name__ == "__main__":
+    main()
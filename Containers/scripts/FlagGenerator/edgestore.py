@@ -0,0 +1,96 @@
+#!/usr/bin/env python2
+import collections
+import os
+import threading
+
+
+class EdgeStore(object):
+    """
+    Remembers the (parent, dependency) edges already sent to the
+    server, so that the many USE combinations of a package, and the
+    same package being triggered again, don't send (or look up) the
+    same edges over and over.
+
+    Up to `size` edges are kept in memory, evicting the least recently
+    used one. If `path` is given, every edge is also appended to a file
+    there, one "parent dependency" per line, and the last `size` of
+    them are read back on start, so the edges survive restarts. An
+    edge that was evicted is only sent again, which the server ignores.
+    """
+
+    def __init__(self, size=65536, path=None):
+        self.size = size
+        self.edges = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.path = path
+        if path is not None:
+            self.load()
+
+    def load(self):
+        """
+        Reads the edges back from the file, and rewrites it with only
+        the ones kept if it has grown to more than twice as many
+        """
+        lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    lines += 1
+                    edge = tuple(line.split())
+                    if len(edge) == 2:
+                        self.remember(edge)
+        except IOError:
+            return
+        if lines > 2 * self.size:
+            tmp = "%s.%d" % (self.path, os.getpid())
+            with open(tmp, "w") as f:
+                f.write("".join("%s %s\n" % k for k in self.edges))
+            os.rename(tmp, self.path)
+
+    def remember(self, edge):
+        self.edges.pop(edge, None)
+        self.edges[edge] = True
+        while len(self.edges) > self.size:
+            self.edges.popitem(last=False)
+
+    def new(self, parent, deps):
+        """
+        Returns the dependencies of parent whose edge was not sent yet
+        """
+        with self.lock:
+            fresh = []
+            for dep in deps:
+                edge = (parent, dep)
+                if edge in self.edges:
+                    self.remember(edge)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    fresh.append(dep)
+            return fresh
+
+    def add(self, parent, deps):
+        """
+        Marks the edges from parent to deps as sent
+        """
+        if not deps:
+            return
+        with self.lock:
+            for dep in deps:
+                self.remember((parent, dep))
+            if self.path is not None:
+                # A single O_APPEND write, so the lines of the
+                # pre-forked workers sharing the file don't interleave
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                try:
+                    os.write(fd, "".join("%s %s\n" % (parent, dep)
+                                         for dep in deps))
+                finally:
+                    os.close(fd)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.edges)}
@@ -0,0 +1,193 @@
+#!/usr/bin/env python2
+import multiprocessing
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Rate limiter allowing `rate` requests per second on average, and
+    bursts of up to `capacity` requests when it has been idle.
+    For eg. TokenBucket(2, 4) lets 4 requests through at once, and
+    then one every half second. The bucket is per process, so forked
+    workers each need one with their share of the rate.
+    """
+    def __init__(self, rate, capacity=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """
+        Takes a token, blocking until one is available. Returns the
+        time spent waiting, in seconds.
+        """
+        waited = 0.0
+        with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                self.sleep(delay)
+                waited += delay
+                self.refill()
+            self.tokens -= 1
+        return waited
+
+
+class Backpressure(object):
+    """
+    Holds back a producer while the consumer reports that it has
+    `limit` or more jobs queued up. The depth comes from the responses
+    of the consumer (update), and while it is too high the consumer is
+    polled with exponential backoff until it drains (wait).
+    """
+    def __init__(self, limit, delay=1.0, max_delay=60.0, sleep=time.sleep):
+        self.limit = limit
+        self.delay = delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.depth = 0
+
+    def update(self, depth):
+        """
+        Records the queue depth reported by the consumer (None if it
+        did not report one, in which case it is not limited)
+        """
+        self.depth = int(depth) if depth is not None else 0
+
+    def saturated(self):
+        return self.depth >= self.limit
+
+    def wait(self, poll):
+        """
+        Blocks while the consumer is saturated, calling poll() for its
+        new depth after every pause. Returns the time spent waiting.
+        """
+        waited = 0.0
+        delay = self.delay
+        while self.saturated():
+            self.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, self.max_delay)
+            self.update(poll())
+        return waited
+
+
+def read_number(path):
+    """
+    The first number in a file, or None if there isn't one (for eg.
+    cgroup files holding "max")
+    """
+    try:
+        with open(path) as f:
+            return int(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def cpu_count(cgroup="/sys/fs/cgroup"):
+    """
+    Number of cores this process may use: the CPU quota of its cgroup
+    (what a pod is limited to) if there is one, else every core
+    """
+    cores = multiprocessing.cpu_count()
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>"
+        with open(cgroup + "/cpu.max") as f:
+            quota, period = f.read().split()
+        quota, period = int(quota), int(period)
+    except (IOError, OSError, ValueError):
+        # cgroup v1, -1 for no quota
+        quota = read_number(cgroup + "/cpu/cpu.cfs_quota_us")
+        period = read_number(cgroup + "/cpu/cpu.cfs_period_us")
+    if quota > 0 and period > 0:
+        cores = min(cores, max(1, quota // period))
+    return cores
+
+
+def available_memory(meminfo="/proc/meminfo", cgroup="/sys/fs/cgroup"):
+    """
+    Memory in kB that can still be used without swapping or hitting
+    the limit of the cgroup, or None if it cannot be told
+    """
+    free = []
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    free.append(int(line.split()[1]))
+    except (IOError, OSError, ValueError):
+        pass
+    for limit, usage in [("memory.max", "memory.current"),
+                         ("memory/memory.limit_in_bytes",
+                          "memory/memory.usage_in_bytes")]:
+        limit = read_number(cgroup + "/" + limit)
+        usage = read_number(cgroup + "/" + usage)
+        # v1 reports a huge limit when there is none
+        if limit is not None and usage is not None and limit < 1 << 60:
+            free.append(max(0, limit - usage) // 1024)
+            break
+    return min(free) if free else None
+
+
+class ResourceGate(object):
+    """
+    Lets a job start only while there is a core and `job_memory` kB of
+    memory for it, so a burst of jobs waits instead of oversubscribing
+    the machine (or getting the pod OOM killed). One job may always
+    run, however low memory is.
+    For eg. with gate: run_emerge()
+    """
+    def __init__(self, cores=None, job_memory=512 * 1024, poll=1.0,
+                 memory=available_memory, sleep=time.sleep):
+        self.cores = cores or cpu_count()
+        self.job_memory = job_memory
+        self.poll = poll
+        self.memory = memory
+        self.sleep = sleep
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def admit(self):
+        """
+        Starts a job if there is room for it right now
+        """
+        with self.lock:
+            if self.running >= self.cores:
+                return False
+            if self.running > 0:
+                free = self.memory()
+                if free is not None and free < self.job_memory:
+                    return False
+            self.running += 1
+            return True
+
+    def acquire(self):
+        """
+        Blocks until the job can start. Returns the time spent waiting.
+        """
+        waited = 0.0
+        while not self.admit():
+            self.sleep(self.poll)
+            waited += self.poll
+        return waited
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python2
+import re
+
+# Dependency variables of an ebuild that end up in the merge list
+DEP_KEYS = ["DEPEND", "RDEPEND", "PDEPEND"]
+
+# USE dependencies of an atom, for eg. the [ssl?,-doc] of
+# dev-libs/foo[ssl?,-doc]
+USE_DEP = re.compile(r'\[([^\]]*)\]')
+
+
+def evaluate_use_deps(atom, enabled):
+    """
+    Replaces the conditional USE dependencies of an atom with what
+    they mean for the enabled flags (as portage's
+    Atom.evaluate_conditionals does)
+    For eg. "dev-libs/foo[ssl?,!gtk=]" with ssl enabled gives
+    "dev-libs/foo[ssl,gtk]"
+    """
+    def evaluate(match):
+        deps = []
+        for dep in match.group(1).split(","):
+            # Strip the default of a flag, for eg. ssl(+)?
+            flag = re.sub(r'\([+-]\)', '', dep).strip("!?=")
+            on = flag in enabled
+            if dep.endswith("?"):
+                if dep.startswith("!") and not on:
+                    deps.append("-" + dep[1:-1])
+                elif not dep.startswith("!") and on:
+                    deps.append(dep[:-1])
+            elif dep.endswith("="):
+                negate = dep.startswith("!")
+                body = dep[1:-1] if negate else dep[:-1]
+                deps.append(body if on != negate else "-" + body)
+            else:
+                deps.append(dep)
+        return "[%s]" % ",".join(deps) if deps else ""
+    return USE_DEP.sub(evaluate, atom)
+
+
+def conditional_atom(atom):
+    """
+    Whether the USE dependencies of an atom depend on the flags
+    """
+    return any(dep.endswith("?") or dep.endswith("=")
+               for match in USE_DEP.findall(atom)
+               for dep in match.split(","))
+
+
+# Version of a cpv, for eg. the -1.2.3_rc1-r2 of dev-libs/foo-1.2.3_rc1-r2
+VERSION = re.compile(r'-\d[\w.*]*(-r\d+)?$')
+
+
+def reduce_deps(depstr, enabled=None):
+    """
+    Returns the atoms a dependency string pulls in with the enabled
+    USE flags, in order and without repeats. With enabled None, only
+    the atoms that do not depend on any flag are returned. Blockers are
+    kept as atoms, and || groups are returned as tuples of their
+    choices, each choice a tuple of what it pulls in.
+    For eg. "a/b ssl? ( c/d ) !x/y || ( e/f ( g/h i/j ) )" gives
+    ["a/b", "c/d", "!x/y", (("e/f",), ("g/h", "i/j"))] with ssl, and
+    the same without "c/d" with None.
+    """
+    tokens = depstr.split()
+    atoms, i, conditional = reduce_list(tokens, 0, enabled)
+    if i != len(tokens):
+        raise ValueError("Unbalanced ) in %r" % depstr)
+    result = []
+    for atom in atoms:
+        if atom not in result:
+            result.append(atom)
+    return result
+
+
+def reduce_list(tokens, i, enabled, choices=False):
+    """
+    Reduces tokens[i:] up to the closing ")" of the current group.
+    With choices, these are the choices of a || group, and each one is
+    reduced to a tuple of its atoms. Returns (atoms, position of the
+    ")", whether anything in there depends on the flags).
+    """
+    atoms = []
+    conditional = False
+
+    def add(group):
+        if choices:
+            if group:
+                atoms.append(tuple(group))
+        else:
+            atoms.extend(group)
+
+    while i < len(tokens) and tokens[i] != ")":
+        token = tokens[i]
+        if token == "||" or token.endswith("?"):
+            if i + 1 >= len(tokens) or tokens[i + 1] != "(":
+                raise ValueError("Expected ( after %s" % token)
+            group, i, cond = reduce_list(tokens, i + 2, enabled, token == "||")
+            if i >= len(tokens):
+                raise ValueError("Missing ) after %s" % token)
+            i += 1
+            if token == "||":
+                conditional = conditional or cond
+                # A || group whose choices depend on the flags is not
+                # shared by every combination
+                if group and not (cond and enabled is None):
+                    add([tuple(group)])
+            else:
+                conditional = True
+                flag = token[:-1].lstrip("!")
+                if enabled is not None and (flag in enabled) != token.startswith("!"):
+                    add(group)
+        elif token == "(":
+            group, i, cond = reduce_list(tokens, i + 1, enabled)
+            if i >= len(tokens):
+                raise ValueError("Missing )")
+            i += 1
+            conditional = conditional or cond
+            add(group)
+        else:
+            if enabled is not None:
+                add([evaluate_use_deps(token, enabled)])
+            elif conditional_atom(token):
+                conditional = True
+            else:
+                add([token])
+            i += 1
+    return atoms, i, conditional
+
+
+def split_delta(depstrs, enabled):
+    """
+    Splits the atoms pulled in by the dependency strings with the
+    enabled flags into (base, delta): the atoms every combination
+    pulls in, and the ones only this combination does
+    """
+    base, combo = [], []
+    for depstr in depstrs:
+        base += [k for k in reduce_deps(depstr) if k not in base]
+        combo += [k for k in reduce_deps(depstr, enabled) if k not in combo]
+    return base, [k for k in combo if k not in base]
+
+
+def dep_string(atom):
+    """
+    Writes an atom or a || group back as in a dependency string
+    """
+    if not isinstance(atom, tuple):
+        return atom
+    return "|| ( %s )" % " ".join(
+        dep_string(k[0]) if len(k) == 1 else
+        "( %s )" % " ".join(dep_string(j) for j in k) for k in atom)
+
+
+def blocker_cp(blocker):
+    """
+    The category/package a blocker is about, for eg. "dev-libs/foo"
+    for "!!<dev-libs/foo-2:0[ssl]"
+    """
+    atom = blocker.lstrip("!")
+    name = atom.lstrip("<>=~")
+    name = name.split("[")[0].split(":")[0]
+    if name != atom.split("[")[0].split(":")[0]:
+        name = VERSION.sub("", name)
+    return name
+
+
+def blocked(blockers, deps):
+    """
+    Whether a package of the merge list has the name of one of the
+    blockers. Versions are not compared, so this may also say so for a
+    version the blocker does not match.
+    """
+    names = set(blocker_cp(k) for k in blockers)
+    return any(VERSION.sub("", k) in names for k in deps)
+
+
+class Planner(object):
+    """
+    Resolves the USE combinations of a package incrementally. The
+    atoms every combination pulls in (the base) are resolved once per
+    package, and for each combination only the atoms its flags add
+    (the delta), so an extra combination costs as much as what it
+    changes. Deltas are shared between combinations too.
+
+    resolve(atoms) returns (merge list, ok) for a list of atoms, for
+    eg. by running emerge -pUuD on them. Its results are kept in
+    `plans`, keyed with `key(name)`.
+
+    emerge takes neither || groups nor blockers on its command line.
+    For a || group, its first choice that is installed(atom) (or else
+    its first choice) is resolved, and the next ones if that fails, as
+    portage prefers them. Blockers pull nothing in; if a package they
+    name ends up in the merge list, the combination is resolved as a
+    whole instead.
+    """
+    def __init__(self, resolve, plans, key, installed=None):
+        self.resolve = resolve
+        self.plans = plans
+        self.key = key
+        self.installed = installed
+
+    def preferred(self, group):
+        """
+        The choices of a || group in the order they are tried
+        """
+        if self.installed is None:
+            return list(group)
+        have = [k for k in group if all(
+            isinstance(j, tuple) or j.startswith("!") or self.installed(j)
+            for j in k)]
+        return have + [k for k in group if k not in have]
+
+    def choose(self, atoms, picks=None):
+        """
+        The atoms with each || group replaced by its choice in picks
+        (by position among the groups, the preferred one if missing)
+        """
+        picks = picks or {}
+        chosen = []
+        groups = 0
+        for atom in atoms:
+            if not isinstance(atom, tuple):
+                chosen.append(atom)
+                continue
+            choices = self.preferred(atom)
+            # A choice may hold || groups of its own
+            chosen += self.choose(choices[picks.get(groups, 0)])
+            groups += 1
+        return chosen
+
+    def alternatives(self, atoms):
+        """
+        The lists of atoms to try for atoms with || groups: the
+        preferred choice of every group, then each other choice of one
+        group at a time
+        """
+        yield self.choose(atoms)
+        groups = [k for k in atoms if isinstance(k, tuple)]
+        for n, group in enumerate(groups):
+            for pick in range(1, len(group)):
+                yield self.choose(atoms, {n: pick})
+
+    def resolved(self, name, atoms):
+        """
+        The merge list of atoms, from the plans if they have it
+        """
+        if not atoms:
+            return [], True
+        deps = self.plans.get(*self.key(name))
+        if deps is not None:
+            return deps, True
+        first = None
+        for choice in self.alternatives(atoms):
+            choice = [k for k in choice if not k.startswith("!")]
+            deps, ok = self.resolve(choice) if choice else ([], True)
+            if ok:
+                self.plans.put(*(self.key(name) + (deps,)))
+                return deps, ok
+            if first is None:
+                first = deps
+        return first, False
+
+    def plan(self, cpv, depstrs, combo):
+        """
+        Returns (merge list, ok) of cpv built with the USE combination
+        (a list of flags such as ["a", "-b"]), or None if it cannot be
+        done incrementally, in which case cpv has to be resolved as a
+        whole
+        """
+        enabled = set(k for k in combo if not k.startswith("-"))
+        base, delta = split_delta(depstrs, enabled)
+
+        deps, ok = self.resolved("base:" + cpv, base)
+        if not ok:
+            return deps, False
+        if delta:
+            more, ok = self.resolved(
+                "delta:" + " ".join(sorted(dep_string(k) for k in delta)), delta)
+            if not ok:
+                return more, False
+            deps = deps + [k for k in more if k not in deps]
+
+        blockers = [j for k in base + delta
+                    for j in (self.choose([k]) if isinstance(k, tuple) else [k])
+                    if j.startswith("!")]
+        if blocked(blockers, deps):
+            return None
+        return deps + [cpv], True
@@ -0,0 +1,306 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+# Metadata cache of the portage tree, with one file per ebuild
+MD5_CACHE = "/usr/portage/metadata/md5-cache"
+
+# Keys kept in the index, out of everything in the md5-cache
+KEYS = ["IUSE", "REQUIRED_USE", "KEYWORDS", "SLOT", "EAPI",
+        "DEPEND", "RDEPEND", "PDEPEND"]
+
+# The tree is checked for changes at most this often (in seconds)
+REFRESH_INTERVAL = 60
+
+# Layout of the index file:
+#   header: magic, number of ebuilds, then the size of the keys, cpvs
+#           and records blobs, and the stamp of the tree it was built from
+#   keys blob: the indexed keys, separated by newlines
+#   n + 1 offsets of the cpvs in the cpvs blob (sorted cpvs)
+#   n + 1 offsets of the records in the records blob
+#   n sizes and n mtimes of the md5-cache files (to refresh incrementally)
+#   cpvs blob, records blob: the values of an ebuild separated by newlines
+MAGIC = "ORCAMD1\n"
+HEADER = struct.Struct("<8sIIIId")
+
+
+def read_metadata(path):
+    """
+    Reads an md5-cache entry (KEY=VALUE lines) into a dict
+    """
+    metadata = {}
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.rstrip("\n").partition("=")
+            if sep:
+                metadata[key] = value
+    return metadata
+
+
+def tree_stamp(root):
+    """
+    Changes whenever the tree is synced: the latest mtime of the
+    md5-cache directory, its categories and the sync timestamp
+    """
+    paths = [root, os.path.join(os.path.dirname(root), "timestamp.chk")]
+    if os.path.isdir(root):
+        paths += [os.path.join(root, k) for k in os.listdir(root)]
+    stamp = 0.0
+    for path in paths:
+        try:
+            stamp = max(stamp, os.stat(path).st_mtime)
+        except OSError:
+            pass
+    return stamp
+
+
+def scan(root):
+    """
+    Yields (cpv, path, stat) for every file of the md5-cache, sorted
+    by cpv
+    """
+    entries = []
+    if not os.path.isdir(root):
+        return
+    for category in os.listdir(root):
+        folder = os.path.join(root, category)
+        if not os.path.isdir(folder):
+            continue
+        for pf in os.listdir(folder):
+            entries.append((category + "/" + pf, os.path.join(folder, pf)))
+    entries.sort()
+    for cpv, path in entries:
+        try:
+            yield cpv, path, os.stat(path)
+        except OSError:
+            # Removed while we were looking
+            pass
+
+
+class View(object):
+    """
+    Read-only view of one index file, memory-mapped. Lookups are
+    binary searches over the sorted cpvs, nothing is loaded up front.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.n, keys_len, cpvs_len, records_len,
+         self.stamp) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a metadata index" % path)
+        pos = HEADER.size
+        self.keys = self.mm[pos:pos + keys_len].split("\n")
+        self.columns = dict((k, i) for i, k in enumerate(self.keys))
+        pos += keys_len
+        n = self.n
+        self.cpv_offsets = pos
+        self.record_offsets = pos + 4 * (n + 1)
+        self.sizes = self.record_offsets + 4 * (n + 1)
+        self.mtimes = self.sizes + 4 * n
+        self.cpvs = self.mtimes + 8 * n
+        self.records = self.cpvs + cpvs_len
+
+    def __len__(self):
+        return self.n
+
+    def offsets(self, table, i):
+        return struct.unpack_from("<II", self.mm, table + 4 * i)
+
+    def cpv(self, i):
+        start, end = self.offsets(self.cpv_offsets, i)
+        return self.mm[self.cpvs + start:self.cpvs + end]
+
+    def find(self, cpv):
+        """
+        Returns the position of cpv in the index, or -1
+        """
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.cpv(mid) < cpv:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n and self.cpv(lo) == cpv:
+            return lo
+        return -1
+
+    def record(self, i):
+        start, end = self.offsets(self.record_offsets, i)
+        return self.mm[self.records + start:self.records + end]
+
+    def stat(self, i):
+        size = struct.unpack_from("<I", self.mm, self.sizes + 4 * i)[0]
+        mtime = struct.unpack_from("<d", self.mm, self.mtimes + 8 * i)[0]
+        return size, mtime
+
+
+def write_index(path, keys, entries, stamp):
+    """
+    Writes the index file for entries, a sorted list of
+    (cpv, size, mtime, record). The file is replaced atomically, so
+    readers never see half of it.
+    """
+    n = len(entries)
+    cpv_offsets, record_offsets = [0], [0]
+    for cpv, size, mtime, record in entries:
+        cpv_offsets.append(cpv_offsets[-1] + len(cpv))
+        record_offsets.append(record_offsets[-1] + len(record))
+    keys_blob = "\n".join(keys)
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n, len(keys_blob), cpv_offsets[-1],
+                            record_offsets[-1], stamp))
+        f.write(keys_blob)
+        f.write(struct.pack("<%dI" % (n + 1), *cpv_offsets))
+        f.write(struct.pack("<%dI" % (n + 1), *record_offsets))
+        f.write(struct.pack("<%dI" % n, *[k[1] for k in entries]))
+        f.write(struct.pack("<%dd" % n, *[k[2] for k in entries]))
+        for entry in entries:
+            f.write(entry[0])
+        for entry in entries:
+            f.write(entry[3])
+    os.rename(tmp, path)
+
+
+class MetadataIndex(object):
+    """
+    Bulk access to the metadata of the ebuilds in the md5-cache,
+    through a compact index file that is memory-mapped. The index is
+    built on first use and refreshed incrementally when the tree
+    changes (only the md5-cache files that changed are read again).
+    For eg. MetadataIndex("/var/cache/orca/metadata.idx").get(
+    ["app-misc/foo-1.0"], ["IUSE", "KEYWORDS"]) gives
+    [["+a b", "~amd64"]]
+    """
+    def __init__(self, path, root=MD5_CACHE, keys=KEYS,
+                 interval=REFRESH_INTERVAL):
+        self.path = path
+        self.root = root
+        self.keys = list(keys)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.view = None
+        self.checked = 0
+        try:
+            view = View(path)
+            if view.keys == self.keys:
+                self.view = view
+        except (IOError, OSError, ValueError, struct.error):
+            pass
+
+    def refresh(self, force=False):
+        """
+        Brings the index up to date with the md5-cache. Returns
+        (added, changed, removed), or None if the tree has not changed
+        since the last time (unless force is set).
+        """
+        with self.lock:
+            self.checked = time.time()
+            stamp = tree_stamp(self.root)
+            old = self.view
+            if old is not None and old.stamp == stamp and not force:
+                return None
+
+            # Both the scan and the old index are sorted by cpv, so
+            # walk through them side by side
+            added, changed, entries = 0, 0, []
+            j, n = 0, len(old) if old is not None else 0
+            for cpv, path, st in scan(self.root):
+                while j < n and old.cpv(j) < cpv:
+                    j += 1
+                i = j if j < n and old.cpv(j) == cpv else -1
+                if i >= 0 and old.stat(i) == (st.st_size, st.st_mtime):
+                    record = old.record(i)
+                else:
+                    metadata = read_metadata(path)
+                    record = "\n".join(metadata.get(k, "") for k in self.keys)
+                    if i >= 0:
+                        changed += 1
+                    else:
+                        added += 1
+                entries.append((cpv, st.st_size, st.st_mtime, record))
+            removed = (len(old) if old is not None else 0) - \
+                (len(entries) - added)
+
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            write_index(self.path, self.keys, entries, stamp)
+            # Readers still holding the old view keep their own map
+            self.view = View(self.path)
+            return added, changed, removed
+
+    def current(self):
+        """
+        The view to read from, refreshing it first if it is missing
+        or if it is time to check the tree again
+        """
+        if self.view is None or time.time() - self.checked >= self.interval:
+            self.refresh()
+        return self.view
+
+    def get(self, cpvs, keys, fallback=None):
+        """
+        Returns the values of keys for each of cpvs, as a list with a
+        list of values per cpv. A cpv not in the index (for eg. from an
+        overlay) gets None, or fallback(cpv, keys) if given, which can
+        be portage's own db.aux_get.
+        """
+        view = self.current()
+        try:
+            columns = [view.columns[k] for k in keys]
+        except KeyError as e:
+            raise KeyError("%s is not indexed" % e.args[0])
+        result = []
+        for cpv in cpvs:
+            i = view.find(cpv)
+            if i < 0:
+                result.append(fallback(cpv, keys) if fallback else None)
+                continue
+            values = view.record(i).split("\n")
+            result.append([values[k] for k in columns])
+        return result
+
+    def aux_get(self, cpv, keys):
+        """
+        Same as portage's dbapi.aux_get, for one ebuild
+        """
+        values = self.get([cpv], keys)[0]
+        if values is None:
+            raise KeyError(cpv)
+        return values
+
+    def __contains__(self, cpv):
+        return self.current().find(cpv) >= 0
+
+    def __len__(self):
+        return len(self.current())
+
+
+def main(argv):
+    """
+    Builds or refreshes the index, for eg. after emerge --sync:
+        metadata.py /var/cache/orca/metadata.idx [md5-cache]
+    """
+    if not argv:
+        print("Usage: metadata.py INDEX [MD5_CACHE]", file=sys.stderr)
+        return 2
+    root = argv[1] if len(argv) > 1 else MD5_CACHE
+    start = time.time()
+    index = MetadataIndex(argv[0], root)
+    added, changed, removed = index.refresh(force=True)
+    print("Indexed %d ebuilds in %.1fs (%d added, %d changed, %d removed)" %
+          (len(index), time.time() - start, added, changed, removed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
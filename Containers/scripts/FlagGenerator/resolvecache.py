@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+
+
+def normalize_use(use):
+    """
+    Returns the USE flags that a USE string ends up setting, as a
+    sorted list, the last mention of a flag winning (like portage's
+    incremental USE). Flags that are not mentioned are left to the
+    profile, so "-a" is kept apart from not having a at all.
+    For eg. "a b -a test c" gives ["-a", "b", "c", "test"]
+    """
+    flags = {}
+    for flag in use.split():
+        if flag == "-*":
+            flags = {"-*": True}
+        elif flag.startswith("-"):
+            flags[flag[1:]] = False
+        else:
+            flags[flag.lstrip("+")] = True
+    return sorted(k if v or k == "-*" else "-" + k
+                  for k, v in flags.items())
+
+
+def tree_snapshot(portdir):
+    """
+    Identifies the state of the portage tree: the timestamp of its
+    last sync, or the commit it is at for a git tree. Changes with
+    every emerge --sync.
+    """
+    try:
+        with open(os.path.join(portdir, "metadata", "timestamp.chk")) as f:
+            return f.read().strip()
+    except IOError:
+        pass
+    if os.path.isdir(os.path.join(portdir, ".git")):
+        try:
+            return subprocess.check_output(
+                ["git", "-C", portdir, "rev-parse", "HEAD"]).strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    try:
+        return str(os.stat(portdir).st_mtime)
+    except OSError:
+        return ""
+
+
+def profile_of(config_root="/"):
+    """
+    The profile portage is using, for eg.
+    /usr/portage/profiles/default/linux/amd64/13.0
+    """
+    return os.path.realpath(
+        os.path.join(config_root, "etc", "portage", "make.profile"))
+
+
+class ResolutionCache(object):
+    """
+    Persistent cache of emerge --pretend results, keyed by the cpv, the
+    USE flags it was resolved with (normalized), the tree snapshot and
+    the profile. A sync changes the snapshot, so older plans are never
+    served again, and prune() drops them.
+
+    With a path, the plans are kept in an sqlite database there, which
+    survives restarts and can be shared by the dependency service and
+    the build containers. Without one, they are kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ":memory:"
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connect()
+
+    def connect(self):
+        """
+        Opens the database, again in a forked process (an sqlite
+        connection must not be shared between processes)
+        """
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(self.path, timeout=60,
+                                  check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS plans "
+                        "(key TEXT PRIMARY KEY, snapshot TEXT, value TEXT)")
+        self.db.commit()
+
+    def database(self):
+        if self.pid != os.getpid() and self.path != ":memory:":
+            self.connect()
+        return self.db
+
+    def key(self, cpv, use, snapshot, profile):
+        return json.dumps([cpv, normalize_use(use), snapshot, profile])
+
+    def get(self, cpv, use, snapshot, profile):
+        """
+        Returns the plan (list of cpvs to merge) or None
+        """
+        key = self.key(cpv, use, snapshot, profile)
+        with self.lock:
+            row = self.database().execute(
+                "SELECT value FROM plans WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [str(k) for k in json.loads(row[0])]
+
+    def put(self, cpv, use, snapshot, profile, plan):
+        key = self.key(cpv, use, snapshot, profile)
+        with self.lock:
+            db = self.database()
+            db.execute("INSERT OR REPLACE INTO plans VALUES (?, ?, ?)",
+                       (key, snapshot, json.dumps(plan)))
+            db.commit()
+
+    def prune(self, snapshot):
+        """
+        Drops the plans of every tree snapshot but this one. Returns
+        how many were dropped.
+        """
+        with self.lock:
+            db = self.database()
+            dropped = db.execute("DELETE FROM plans WHERE snapshot != ?",
+                                 (snapshot,)).rowcount
+            db.commit()
+            return dropped
+
+    def stats(self):
+        with self.lock:
+            entries = self.database().execute(
+                "SELECT COUNT(*) FROM plans").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": entries}
@@ -0,0 +1,136 @@
+#!/usr/bin/env python2
+import threading
+
+# What emerge -pUuD asks for
+OPTIONS = {
+    "--pretend": True,
+    "--update": True,
+    "--changed-use": True,
+    "--deep": True,
+    "--quiet": True,
+}
+
+
+def reason(pkg, vardb, vercmp=None):
+    """
+    Why a package is in the merge list, compared with what is
+    installed in its slot: new, update, downgrade or reinstall.
+    Versions are compared with portage's vercmp unless another one
+    is given.
+    """
+    installed = vardb.match(pkg.slot_atom)
+    if not installed:
+        return "new"
+    if vercmp is None:
+        from portage.versions import vercmp
+    diff = vercmp(pkg.version, installed[-1].version)
+    if diff > 0:
+        return "update"
+    if diff < 0:
+        return "downgrade"
+    return "reinstall"
+
+
+def merge_list(graph, vardb, vercmp=None):
+    """
+    The packages a resolved depgraph merges, as a list of
+    {"cpv", "use", "slot", "reason"} in merge order
+    """
+    merge = []
+    for pkg in graph.altlist():
+        # Blockers and packages that are only uninstalled are left out
+        if getattr(pkg, "operation", None) != "merge":
+            continue
+        merge.append({
+            "cpv": str(pkg.cpv),
+            "use": sorted(pkg.use.enabled),
+            "slot": pkg.slot,
+            "reason": reason(pkg, vardb, vercmp),
+        })
+    return merge
+
+
+class Resolver(object):
+    """
+    Resolves the dependencies of a package inside this process with
+    portage's depgraph, as emerge -pUuD would, but without starting
+    emerge (and all of portage) again for every USE combination. The
+    emerge configuration is loaded once and cloned for each call.
+
+    portage is not thread safe, so calls are serialized. Run several
+    pre-forked workers to resolve in parallel.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.lock = threading.Lock()
+        self.config = None
+
+    def load(self):
+        if self.config is None:
+            self.tree.load()
+            from _emerge.actions import load_emerge_config
+            from _emerge.create_depgraph_params import create_depgraph_params
+            self.config = load_emerge_config()
+            self.params = create_depgraph_params(OPTIONS, None)
+        return self.config
+
+    def trees_for(self, use):
+        """
+        Returns (settings, trees) of the loaded configuration, with USE
+        set to `use`. The trees share their dbapis with the loaded ones,
+        only the configuration of the target root is new.
+        """
+        from portage.util import LazyItemsDict
+        from _emerge.RootConfig import RootConfig
+        portage = self.tree.portage
+        base_settings, base_trees, mtimedb = self.load()
+
+        settings = portage.config(clone=base_settings)
+        settings["USE"] = use
+        settings.backup_changes("USE")
+        settings.regenerate()
+        settings.lock()
+
+        root = settings["EROOT"]
+        trees = dict(base_trees)
+        trees[root] = LazyItemsDict(base_trees[root])
+        trees[root]["root_config"] = RootConfig(
+            settings, trees[root], base_trees[root]["root_config"].setconfig)
+        return settings, trees
+
+    def resolve(self, cpv, use):
+        """
+        Returns the merge list of =cpv built with the USE flags, as a
+        list of {"cpv", "use", "slot", "reason"} in merge order. Raises
+        ValueError if portage cannot resolve it (blockers, masked or
+        missing dependencies...).
+        """
+        return self.resolve_atoms(["=" + cpv], use)
+
+    def resolve_atoms(self, atoms, use):
+        """
+        Same as resolve, for a list of atoms, for eg.
+        [">=dev-libs/foo-1.2", "app-misc/bar[ssl]"]
+        """
+        with self.lock:
+            settings, trees = self.trees_for(use)
+            success, graph = self.depgraph(settings, trees, list(atoms))
+            if not success:
+                raise ValueError("portage could not resolve %s" %
+                                 " ".join(atoms))
+            vardb = trees[settings["EROOT"]]["vartree"].dbapi
+            return merge_list(graph, vardb)
+
+    def depgraph(self, settings, trees, atoms):
+        """
+        Runs portage's backtracking depgraph on the atoms, the way
+        emerge -pUuD does. Returns (success, graph).
+        """
+        from _emerge.depgraph import backtrack_depgraph
+        from _emerge.stdout_spinner import stdout_spinner
+        spinner = stdout_spinner()
+        spinner.update = spinner.update_quiet
+        success, graph, favorites = backtrack_depgraph(
+            settings, trees, dict(OPTIONS), self.params, None, atoms,
+            spinner)
+        return success, graph
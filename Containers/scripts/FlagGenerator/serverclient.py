@@ -0,0 +1,66 @@
+#!/usr/bin/env python2
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Seconds to wait for the connection, and then for the response
+TIMEOUT = (5, 60)
+
+
+def make_session(retries=3, backoff=0.5, pool_size=8,
+                 status_forcelist=(502, 503, 504)):
+    """
+    Returns a requests Session that keeps its connections alive and
+    retries failed requests (with exponential backoff) on connection
+    errors and on the status codes of status_forcelist
+    """
+    kwargs = dict(total=retries, backoff_factor=backoff,
+                  status_forcelist=status_forcelist)
+    # Every request sent with this is safe to repeat, POST included
+    try:
+        retry = Retry(allowed_methods=False, **kwargs)
+    except TypeError:
+        retry = Retry(method_whitelist=False, **kwargs)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ServerClient(object):
+    """
+    Talks to the orca server over one pooled session. Everything found
+    for a package is sent in a single request to /bulk.
+    For eg. ServerClient("10.0.0.1").submit("app-misc/foo-1.0",
+    combos=["a -b"], edges=["dev-libs/bar-2"])
+    """
+    def __init__(self, host, session=None, timeout=TIMEOUT):
+        self.base = "http://" + host
+        self.session = session or make_session()
+        self.timeout = timeout
+
+    def submit(self, cpv, combos=(), edges=()):
+        """
+        Adds the USE flag combinations (lists or strings of flags) of
+        cpv, and its dependencies on the unstable packages in edges.
+        Returns the server's reply: {"combos": added, "edges": added}
+        """
+        payload = {
+            "package": cpv,
+            "combos": [k if isinstance(k, basestring) else " ".join(k)
+                       for k in combos],
+            "edges": list(edges),
+        }
+        r = self.session.post(self.base + "/bulk", json=payload,
+                              timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def get(self, url, **kwargs):
+        """
+        GET on another service, through the same pooled session
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
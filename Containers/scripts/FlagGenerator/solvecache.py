@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import collections
+import json
+import os
+import re
+import sqlite3
+import threading
+
+
+def normalize(req_use):
+    """
+    Returns a canonical form of a REQUIRED_USE string, so that
+    strings that only differ in whitespace share a cache entry.
+    For eg. "^^(a  b)" and "^^ ( a b )" both give "^^ ( a b )"
+    """
+    return " ".join(re.sub(r'([()])', r' \1 ', req_use).split())
+
+
+def to_str(value):
+    """
+    json gives back unicode strings in python 2, while the rest of
+    the code works with str. Converts them back, recursively.
+    """
+    if isinstance(value, list):
+        return [to_str(k) for k in value]
+    if isinstance(value, type(u'')):
+        return str(value)
+    return value
+
+
+class SolverCache(object):
+    """
+    Cache of compiled REQUIRED_USE formulas and their solutions.
+
+    Entries are kept in memory up to `size` of them, evicting the
+    least recently used one. If `path` is given, every entry is also
+    written to an sqlite database there, which is looked up on a
+    memory miss, so the cache survives restarts of the flag solver.
+
+    Values are stored as JSON, so every lookup returns a fresh copy
+    that the caller is free to modify.
+    """
+
+    def __init__(self, size=1024, path=None):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.path = path
+        self.db = None
+        if path is not None:
+            self.connect()
+
+    def connect(self):
+        """
+        Opens the sqlite database. A process forked with the cache
+        already open calls this again, as an sqlite connection must
+        not be shared between processes (the memory entries are kept).
+        """
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(self.path, timeout=60,
+                                  check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache "
+                        "(key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def database(self):
+        """
+        The sqlite connection of this process, or None
+        """
+        if self.db is not None and self.pid != os.getpid():
+            self.connect()
+        return self.db
+
+    def key(self, kind, req_use, args):
+        """
+        Returns the key for the result of `kind` of computation on
+        req_use, with any extra arguments that change the result
+        """
+        return json.dumps([kind, normalize(req_use), args])
+
+    def lookup(self, key):
+        """
+        Returns the JSON encoded value for the key, or None
+        """
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+
+            db = self.database()
+            if db is not None:
+                row = db.execute("SELECT value FROM cache WHERE key = ?",
+                                      (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self.remember(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def remember(self, key, value):
+        """
+        Adds the JSON encoded value to the memory cache, evicting
+        the least recently used entry if it is full
+        """
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def store(self, key, value):
+        """
+        Saves the JSON encoded value in memory (and on disk)
+        """
+        with self.lock:
+            self.remember(key, value)
+            db = self.database()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)",
+                           (key, value))
+                db.commit()
+
+    def memoize(self, kind, req_use, args, compute):
+        """
+        Returns the cached result for (kind, req_use, args), calling
+        compute() and caching its result if there isn't one yet.
+        The result has to be JSON serializable.
+        """
+        key = self.key(kind, req_use, args)
+        value = self.lookup(key)
+        if value is None:
+            value = json.dumps(compute())
+            self.store(key, value)
+        return to_str(json.loads(value))
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of the cache
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+            }
@@ -1,296 +1,1004 @@
 #~/usr/bin/env python
 from __future__ import print_function
 import re
-from satispy import Variable, Cnf
-from satispy.solver import Minisat
+import random
+import itertools
 import pycosat
 
 
-def getToken(eq):
+class ParseError(ValueError):
     """
-    Separates out a single token from a string
-    and returns the two pieces. For eg.
+    Raised for a malformed REQUIRED_USE string. `position` is the
+    index in the string at which the problem was found.
+    """
+
+    def __init__(self, message, req_use, position):
+        ValueError.__init__(self, "%s at position %d: %r" % (
+            message, position, req_use[position:position + 20]))
+        self.req_use = req_use
+        self.position = position
+
 
-    if string is:
-        "flag1 (abc cde)"
-    return ("flag1", "(abc cde)")
+# Group operators of REQUIRED_USE and the node type each one
+# is parsed into
+GROUP_OPS = {'||': 'any', '^^': 'one', '??': 'most'}
 
-    If string is:
-        "(abc def (ghi jkl) (abc)) ^^ (abc)"
-    return ("(abc def (ghi jkl) (abc))", "^^ (abc)")
 
+# Tokens of REQUIRED_USE. A flag name followed by a '?' (but not by
+# '??') is the condition of a flag? ( ... ) group.
+FLAG = r'!?\w[\w+@-]*'
+TOKEN = re.compile(r'''\s*(?:
+    (?P<open>\() |
+    (?P<close>\)) |
+    (?P<op>\|\||\^\^|\?\?) |
+    (?P<cond>%s)\s*\?(?!\?) |
+    (?P<flag>%s)
+)''' % (FLAG, FLAG), re.X)
+SPACE = re.compile(r'\s*')
+
+
+def tokenize(req_use):
     """
-    eq = eq.strip()
-    # Empty string case
-    if eq == "": return None, eq
+    Splits a REQUIRED_USE string into a list of (type, text, position)
+    tokens in a single pass, where type is one of open, close, op,
+    cond and flag. For eg. "!a? ( b )" gives
+
+        [('cond', '!a', 0), ('open', '(', 4), ('flag', 'b', 6),
+         ('close', ')', 8)]
+    """
+    tokens = []
+    pos = SPACE.match(req_use).end()
+    while pos < len(req_use):
+        match = TOKEN.match(req_use, pos)
+        if match is None:
+            raise ParseError("Unexpected character", req_use, pos)
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind), match.start(kind)))
+        pos = SPACE.match(req_use, match.end()).end()
+    return tokens
+
+
+def parse(req_use):
+    """
+    Parses a REQUIRED_USE string into a tree of tuples that the
+    encoders can walk without looking at the string again:
+
+        ('flag', name, positive)        a or !a
+        ('all', [nodes])                ( ... ) or the whole string
+        ('any', [nodes])                || ( ... )
+        ('one', [nodes])                ^^ ( ... )
+        ('most', [nodes])               ?? ( ... )
+        ('if', name, positive, [nodes]) a? ( ... ) or !a? ( ... )
+
+    For eg. "a? ( ^^ ( b c ) )" is parsed into
+        ('all', [('if', 'a', True, [('one', [('flag', 'b', True),
+                                              ('flag', 'c', True)])])])
+
+    Raises ParseError if the string is malformed.
+    """
+    tokens = tokenize(req_use)
+    nodes, i = parse_list(req_use, tokens, 0)
+    if i < len(tokens):
+        raise ParseError("Unmatched ')'", req_use, tokens[i][2])
+    return ('all', nodes)
+
+
+def parse_list(req_use, tokens, i):
+    """
+    Parses tokens from index i up to the next unmatched ')' (or the
+    end). Returns the list of parsed nodes and the index at which
+    parsing stopped.
+    """
+    nodes = []
+    while i < len(tokens) and tokens[i][0] != 'close':
+        node, i = parse_term(req_use, tokens, i)
+        nodes.append(node)
+    return nodes, i
+
+
+def parse_group(req_use, tokens, i):
+    """
+    Parses a "( ... )" group starting at index i, and returns the
+    list of nodes inside it and the index after the ')'
+    """
+    if i >= len(tokens) or tokens[i][0] != 'open':
+        pos = tokens[i][2] if i < len(tokens) else len(req_use)
+        raise ParseError("Expected '('", req_use, pos)
+    nodes, j = parse_list(req_use, tokens, i + 1)
+    if j >= len(tokens):
+        raise ParseError("Unmatched '('", req_use, tokens[i][2])
+    return nodes, j + 1
+
+
+def parse_term(req_use, tokens, i):
+    """
+    Parses a single term (a flag or any kind of group) starting at
+    index i, and returns its node and the index after it
+    """
+    kind, text, pos = tokens[i]
+    if kind == 'flag':
+        return ('flag', text.lstrip('!'), text[0] != '!'), i + 1
+    if kind == 'open':
+        nodes, i = parse_group(req_use, tokens, i)
+        return ('all', nodes), i
+    if kind == 'op':
+        nodes, i = parse_group(req_use, tokens, i + 1)
+        return (GROUP_OPS[text], nodes), i
+    if kind == 'cond':
+        # flag? is normally followed by a group, but a single term
+        # is accepted too
+        if i + 1 < len(tokens) and tokens[i + 1][0] == 'open':
+            nodes, j = parse_group(req_use, tokens, i + 1)
+        elif i + 1 < len(tokens) and tokens[i + 1][0] != 'close':
+            node, j = parse_term(req_use, tokens, i + 1)
+            nodes = [node]
+        else:
+            raise ParseError("Condition without a group", req_use, pos)
+        return ('if', text.lstrip('!'), text[0] != '!', nodes), j
+    raise ParseError("Unexpected ')'", req_use, pos)
+
+
+def node_flags(node, found=None):
+    """
+    Returns the list of flag names in the parse tree, in the order
+    in which they first appear
+    """
+    if found is None:
+        found = []
+    if node[0] == 'flag' or node[0] == 'if':
+        if node[1] not in found:
+            found.append(node[1])
+    for child in node[-1] if node[0] != 'flag' else []:
+        node_flags(child, found)
+    return found
+
+
+class Formula(object):
+    """
+    Integer CNF compiled from a REQUIRED_USE string, in the form
+    accepted by pycosat.
+
+    Flag number i (0-based) in `flags` is the variable i + 1.
+    Any variable above len(flags) is an auxiliary variable that
+    was created by the encoders for a nested group.
+    """
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.var = dict((k, i + 1) for i, k in enumerate(flags))
+        self.nvars = len(flags)
+        self.clauses = []
+        # Whether every auxiliary variable is fixed by the value of
+        # the flags (see iter_models)
+        self.defined = True
+
+    def copy(self):
+        """
+        Returns a copy of the Formula that more clauses can be added
+        to without changing this one
+        """
+        f = Formula(self.flags)
+        f.nvars = self.nvars
+        f.clauses = list(self.clauses)
+        f.defined = self.defined
+        return f
+
+    def new_var(self):
+        """
+        Allocates a fresh auxiliary variable
+        """
+        self.nvars += 1
+        return self.nvars
+
+    def translate(self, soln):
+        """
+        Converts a pycosat solution back to the signed flag names
+        returned by main, eg. [1, -2] to ['a', '-b']. Auxiliary
+        variables are dropped.
+        """
+        return [("-" if k < 0 else "") + self.flags[abs(k) - 1]
+                for k in soln if abs(k) <= len(self.flags)]
+
+
+def and_gate(f, lits):
+    """
+    Returns a literal that is true exactly when all of lits are
+    true. A new variable x is defined by the clauses
+        (-x | l1) & (-x | l2) & ... & (x | -l1 | -l2 | ...)
+    so x is fixed by the value of lits and never creates extra
+    solutions.
+    """
+    if len(lits) == 1:
+        return lits[0]
+    x = f.new_var()
+    for lit in lits:
+        f.clauses.append([-x, lit])
+    f.clauses.append([x] + [-lit for lit in lits])
+    return x
+
+
+def or_gate(f, lits):
+    """
+    Returns a literal that is true exactly when any of lits is true
+    (By De Morgan's law, on top of and_gate)
+    """
+    return -and_gate(f, [-lit for lit in lits])
+
+
+def two_gate(f, lits):
+    """
+    Returns a literal that is true exactly when at least two of lits
+    are true. Uses a running OR of the prefix so that the number of
+    clauses grows linearly with len(lits):
+
+        two = OR over i of ( (l1 | ... | l(i-1)) & li )
+    """
+    prefix = lits[0]
+    pairs = []
+    for i in range(1, len(lits)):
+        pairs.append(and_gate(f, [prefix, lits[i]]))
+        if i < len(lits) - 1:
+            prefix = or_gate(f, [prefix, lits[i]])
+    return or_gate(f, pairs)
+
+
+def node_lit(f, node):
+    """
+    Returns a literal that is equivalent to the given node, adding
+    auxiliary variables for any group that is not a plain flag
+    """
+    kind = node[0]
+    if kind == 'flag':
+        return f.var[node[1]] if node[2] else -f.var[node[1]]
+
+    if kind == 'if':
+        cond = f.var[node[1]] if node[2] else -f.var[node[1]]
+        return or_gate(f, [-cond, node_lit(f, ('all', node[3]))])
+
+    lits = [node_lit(f, child) for child in node[1]]
+    # Empty groups are always satisfied
+    if not lits:
+        return and_gate(f, [])
+    if kind == 'all':
+        return and_gate(f, lits)
+    if kind == 'any':
+        return or_gate(f, lits)
+    if len(lits) == 1:
+        return lits[0] if kind == 'one' else and_gate(f, [])
+    if kind == 'one':
+        return and_gate(f, [or_gate(f, lits), -two_gate(f, lits)])
+    if kind == 'most':
+        return -two_gate(f, lits)
+
+
+# Groups up to this size are encoded pairwise, larger ones with a
+# ladder. Both need about the same number of clauses at this size,
+# but the pairwise encoding needs no auxiliary variables.
+PAIRWISE_LIMIT = 8
+
+
+def at_most_one(f, lits, guard, method=None):
+    """
+    Adds clauses allowing at most one of lits to be true
+    (unless one of the guard literals is true).
+
+    method is either 'pairwise' or 'ladder'. If not given, it is
+    picked based on the size of the group.
+    """
+    if method is None:
+        method = 'pairwise' if len(lits) <= PAIRWISE_LIMIT else 'ladder'
+
+    if method == 'pairwise':
+        # (-a | -b) & (-a | -c) & (-b | -c): n(n-1)/2 clauses
+        for i in range(len(lits)):
+            for j in range(i + 1, len(lits)):
+                f.clauses.append(guard + [-lits[i], -lits[j]])
+
+    elif method == 'ladder':
+        # yi is true when any of l1..li is true, and no li may be
+        # true after the ladder has been entered:
+        #     (-y1 | -l2) & (-y2 | -l3) & ...
+        # yi only depends on the lits, so it stays unguarded and
+        # never creates duplicate solutions: 4(n-1) clauses.
+        prefix = lits[0]
+        for i in range(1, len(lits)):
+            f.clauses.append(guard + [-prefix, -lits[i]])
+            if i < len(lits) - 1:
+                prefix = or_gate(f, [prefix, lits[i]])
 
-    # Count to find matching bracket
-    if eq[0] == '(':
-        brack = 0
-        index = 0
-        for ch in eq:
-            if ch == '(':
-                brack += 1
-            elif ch == ')':
-                brack -= 1
-            index += 1
-            if brack == 0:
-                break
-        return ( eq[:index].strip(), eq[index:].strip() )
-    # If token is a flag name instead of bracket
-    # It may also contain a '!' for a NOT
-    elif re.match(r'^[\w!]', eq):
-        token = re.findall(r'^[\w!]+', eq)[0]
-        length = len(token)
-        return ( eq[:length].strip(), eq[length:].strip() )
-
-    # This should ideally never be encountered
     else:
-        print("No token found:", eq)
-        exit(0)
-
-def solveToken(eq):
-    eq = eq.strip()
-
-    # Request for a new token.
-    token, eq = getToken(eq)
-    if token is None: return None, eq
-
-    # If the variable is a negation, Create a negated
-    # variable. Return the relevant variable obj and the
-    # remaining string
-    if token[0] == '!':
-        return ( -Variable(token[1:].strip()), eq )
-
-    # If no negation is present, return just the variable
-    if re.match(r'^[\w]', token):
-        return ( Variable(token.strip()), eq )
-
-    # If the token is a bracketed group, recursively
-    # solve it
-    if token[0] == '(':
-        return ( solve(token[1:-1]), eq )
-
-    # This should ideally never be encountered
-    print("I failed: ", token, eq)
-    exit(0)
-
-
-def all_or(eq):
-    """
-    This is the case of:
-        "|| (aa bb (cc dd))"
-    The input eq in above case would be:
-        "(aa bb (cc dd))"
-    """
-    # Remove the parentheses
-    eq = eq.strip()[1:-1]
-    # Create a blank Cnf object
-    ret = Cnf()
-
-    # Extract next token and OR with ret variable until you
-    # run out of tokens
-    token, eq = solveToken(eq)
-    while token is not None:
-        ret = ret | token
-        token, eq = solveToken(eq)
-
-    return ret
-
-def all_xor(eq):
-    """
-    This is the case of:
-        "^^ (aa bb (cc dd))"
-    The input eq in above case would be:
-        "(aa bb (cc dd))"
-
-    Output would be corresponding to
-    EXACTLY one out of:
-        aa, bb, (cc dd)
-    """
-
-    # Remove the parentheses
-    eq = eq.strip()[1:-1]
-
-    # List to hold all SOLVED tokens: [aa, bb, (cc & dd)]
-    lst = []
-
-    token, eq = solveToken(eq)
-    while token is not None:
-        lst.append(token)
-        token, eq = solveToken(eq)
-    
-    ret = Cnf()
-
-    # Best explained by example: for [a, b, c]
-    # it would create
-    # (a & -b & -c) | (-a & b & -c) | (-a & -b & c)
-    # EXACTLY one of [a, b, c]
-    for a in lst:
-        tmp = Cnf()
-        for b in lst:
-            if a == b:
-                tmp = tmp & b
-            else:
-                tmp = tmp & (-b)
-        ret = ret | tmp
-    return ret
+        raise ValueError("Unknown at most one encoding: " + str(method))
+
+
+def exactly_one(f, lits, guard, method=None):
+    """
+    Adds clauses allowing exactly one of lits to be true
+    (unless one of the guard literals is true)
+    """
+    f.clauses.append(guard + lits)
+    at_most_one(f, lits, guard, method)
 
 
-def at_most(eq):
+def at_most_k(f, lits, k):
     """
-    This is the case of:
-        "?? (aa bb (cc dd))"
-    The input eq in above case would be:
-        "(aa bb (cc dd))"
+    Adds clauses allowing at most k of lits to be true, using the
+    sequential counter encoding (Sinz, 2005): sij is true when at
+    least j of l1..li are true. Needs O(n.k) clauses and variables.
 
-    Output would be corresponding to
-    AT MOST one out of:
-        aa, bb, (cc dd)
+    The counter variables are not fixed by the lits, so this is
+    meant for finding a single solution, not for enumeration.
+    """
+    n = len(lits)
+    if k >= n:
+        return
+    f.defined = False
+    if k <= 0:
+        for lit in lits:
+            f.clauses.append([-lit])
+        return
+
+    # s[i][j] stands for "at least j + 1 of l1..l(i+1) are true"
+    s = [[f.new_var() for j in range(k)] for i in range(n - 1)]
+
+    f.clauses.append([-lits[0], s[0][0]])
+    for j in range(1, k):
+        f.clauses.append([-s[0][j]])
+
+    for i in range(1, n - 1):
+        f.clauses.append([-lits[i], s[i][0]])
+        f.clauses.append([-s[i - 1][0], s[i][0]])
+        for j in range(1, k):
+            f.clauses.append([-lits[i], -s[i - 1][j - 1], s[i][j]])
+            f.clauses.append([-s[i - 1][j], s[i][j]])
+        f.clauses.append([-lits[i], -s[i - 1][k - 1]])
+
+    f.clauses.append([-lits[n - 1], -s[n - 2][k - 1]])
+
+
+def encode(f, node, guard):
     """
+    Adds the clauses that force the node to be true to the Formula.
+    `guard` holds the negated conditions of the enclosing `flag?`
+    groups, and is added to every clause, so
+
+        a? ( b !c )  becomes  (-a | b) & (-a | -c)
 
-    eq = eq.strip()[1:-1]
-    lst = []
+    without needing any auxiliary variable.
+    """
+    kind = node[0]
+    if kind == 'flag':
+        f.clauses.append(guard + [node_lit(f, node)])
+    elif kind == 'all':
+        for child in node[1]:
+            encode(f, child, guard)
+    elif kind == 'if':
+        cond = f.var[node[1]] if node[2] else -f.var[node[1]]
+        for child in node[3]:
+            encode(f, child, guard + [-cond])
+    elif node[1]:
+        # Only the direct members of the group need a literal,
+        # deeper groups are handled by node_lit recursively
+        lits = [node_lit(f, child) for child in node[1]]
+        if kind == 'any':
+            f.clauses.append(guard + lits)
+        elif kind == 'one':
+            exactly_one(f, lits, guard)
+        elif kind == 'most':
+            at_most_one(f, lits, guard)
+
+
+# Cache for compiled formulas and solutions (a
+# solvecache.SolverCache), or None to always compute them
+cache = None
+
+
+def compile_cnf(req_use, extra_flags=()):
+    """
+    Compiles a REQUIRED_USE string directly into a Formula of
+    integer clauses, without going through satispy.
 
-    token, eq = solveToken(eq)
-    while token is not None:
-        lst.append(token)
-        token, eq = solveToken(eq)
+    Flags in extra_flags that don't appear in req_use (eg. the rest
+    of IUSE) are numbered after the flags of req_use, and are left
+    unconstrained.
+    """
+    if cache is None:
+        return build_cnf(req_use, extra_flags)
+
+    def compute():
+        f = build_cnf(req_use, extra_flags)
+        return [f.flags, f.nvars, f.clauses]
+    flags, nvars, clauses = cache.memoize('cnf', req_use, list(extra_flags), compute)
+    f = Formula(flags)
+    f.nvars, f.clauses = nvars, clauses
+    return f
+
+
+def build_cnf(req_use, extra_flags):
+    """
+    Parses and encodes req_use into a new Formula (compile_cnf
+    without the cache)
+    """
+    tree = parse(req_use)
 
-    ret = Cnf()
-    for a in lst:
-        tmp = Cnf()
-        for b in lst:
-            if str(a) == str(b):
-                tmp = tmp & b
+    # Assign a number to each flag, longest flags first (the same
+    # numbering the string replacement used, so the solutions come
+    # out in the same order as before)
+    flags = sorted(list(set(node_flags(tree))), key=len)
+    flags.reverse()
+    flags += [k for k in extra_flags if k not in flags]
+
+    f = Formula(flags)
+    encode(f, tree, [])
+    return f
+
+
+def iter_models(f, project=None):
+    """
+    Generator over the solutions of a Formula (in pycosat form),
+    producing every distinct assignment of the flags exactly once.
+
+    pycosat.itersolve blocks each solution over all the variables,
+    so an encoding whose auxiliary variables can take more than one
+    value for the same flags would make it return duplicates. With
+    `project`, each solution is instead blocked only over the flags,
+    so the solver never visits the same flags twice. By default this
+    is done only when needed (f.defined is False), as itersolve keeps
+    its state between solutions and is faster.
+    """
+    if project is None:
+        project = not f.defined
+    if not project:
+        for soln in pycosat.itersolve(f.clauses, vars=f.nvars):
+            yield soln
+        return
+
+    n = len(f.flags)
+    clauses = list(f.clauses)
+    while True:
+        soln = pycosat.solve(clauses, vars=f.nvars)
+        if soln == "UNSAT":
+            return
+        yield soln
+        clauses.append([-k for k in soln[:n]])
+
+
+def propagate(clauses):
+    """
+    Unit propagation: repeatedly assigns the variable of every clause
+    that has only one literal left, and simplifies the rest.
+
+    Returns a dict of the fixed variables (variable -> True/False)
+    and the remaining clauses, none of which mention a fixed
+    variable. Returns (None, None) if the clauses contradict.
+    """
+    value = {}
+    changed = True
+    while changed:
+        changed = False
+        remaining = []
+        for clause in clauses:
+            if any(value.get(abs(k)) == (k > 0) for k in clause):
+                continue
+            clause = [k for k in clause if abs(k) not in value]
+            if not clause:
+                return None, None
+            if len(set(clause)) == 1:
+                value[abs(clause[0])] = clause[0] > 0
+                changed = True
             else:
-                tmp = tmp & (-b)
-        ret = ret | tmp
-        # Same as xor_all till here
-
-    tmp = Cnf()
-        # One extra case in which all are negative
-    for b in lst:
-        tmp = tmp & (-b)
-    ret = ret | tmp
-
-    return ret
-
-
-def solve(eq):
-    """
-    This is the primary solve function that is called
-    on the req_use string
-    The string can start with following:
-    1. || or ?? or ^^:
-
-       i.   || :
-                strip the first two characters,
-                extract the next token and call all_or
-       ii.  ^^ :
-                strip the first two characters,
-                extract the next token and call all_xor
-       iii. ?? :
-                strip the first two characters,
-                extract the next token and call at_most
-
-    2. flag1? (abc def) (....)
-        
-        Beak into "flag1?" and "(abc def) (....)"
-        Make flag1 into a variable var1
-        Solve the first token "(abc def)" to var2
-        Condition1 is var1 => var2 (implication)
-        Condition2 is (...) solved by `solve` recursively
-        Return AND of Condition 1 & 2
-    3. normal_flag
-
-        Most probably shouldn't occur (if it's compulsory
-        then it shouldn't be a USE flag). But if it does,
-        convert to variable and & with recursively solved
-        rest of the equation.
-    """
-    eq = eq.strip()
-    if eq == '': return Cnf()
-
-    op = re.findall(r'^(\^\^|\|\||\?\?)', eq)
-    if op:
-        op = op[0]
-        if op == '||':
-            var, eq = getToken(eq[2:])
-            assert var[0] == '(' and var[-1] == ')'
-            result = all_or(var)
-        elif op == '^^':
-            var, eq = getToken(eq[2:])
-            assert var[0] == '(' and var[-1] == ')'
-            result = all_xor(var)
-        elif op == '??':
-            var, eq = getToken(eq[2:])
-            assert var[0] == '(' and var[-1] == ')'
-            result = at_most(var)
-        return result & solve(eq)
-
-    op = re.findall(r'^[\w]+\s*\?(?!\?)', eq)
-    if op:
-        op = op[0]
-        eq = eq[len(op):]
-        var1 = Variable(op[:-1].strip())
-        var2, eq = solveToken(eq)
-        return (var1 >> var2) & solve(eq)
-
-    op = re.findall(r'^!?[\w]+', eq)
-    if op:
-        var, eq = solveToken(eq)
-        return var & solve(eq)
-
-        # This should ideally never be encountered
-    print("I failed", eq);
-    exit(1)
-
-def main(req_use):
+                remaining.append(clause)
+        clauses = remaining
+    return value, clauses
+
+
+class Lazy(object):
+    """
+    Wraps an iterator, remembering the items it produced so that it
+    can be iterated over again from the start, while only pulling
+    new items from the iterator when they are needed
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.items = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self.items):
+                try:
+                    self.items.append(next(self.iterator))
+                except StopIteration:
+                    return
+            yield self.items[i]
+            i += 1
+
+
+def lazy_product(sources, i=0):
+    """
+    Like itertools.product, but without reading all of the sources
+    before the first item is produced
+    """
+    if i == len(sources):
+        yield []
+        return
+    for item in sources[i]:
+        for rest in lazy_product(sources, i + 1):
+            yield [item] + rest
+
+
+class Decomposition(object):
+    """
+    A Formula after unit propagation, split into components that
+    don't share any variable. A solution of the Formula is the fixed
+    flags together with any one solution of each component, so the
+    components can be solved separately.
+
+    `fixed` maps the fixed flag variables to their value, and each of
+    `components` is a (Formula, gvars) pair: a renumbered Formula of
+    its own, and the variable in the original Formula of each of its
+    flags. A flag that no clause mentions is a component on its own.
+    """
+
+    def __init__(self, f, fixed, components):
+        self.formula = f
+        self.fixed = fixed
+        self.components = components
+
+    def assemble(self, parts):
+        """
+        Converts one solution of every component (in pycosat form)
+        to a solution of the original Formula (flags only)
+        """
+        soln = [0] * len(self.formula.flags)
+        for var, value in self.fixed.items():
+            soln[var - 1] = var if value else -var
+        for (g, gvars), local in zip(self.components, parts):
+            for i, var in enumerate(gvars):
+                soln[var - 1] = var if local[i] > 0 else -var
+        return soln
+
+    def itersolve(self, project=None):
+        """
+        Generator over the solutions of the Formula (in pycosat form),
+        combining the solutions of the components lazily
+        """
+        sources = [Lazy(iter_models(g, project)) for g, gvars in self.components]
+        for parts in lazy_product(sources):
+            yield self.assemble(parts)
+
+    def count(self):
+        """
+        Returns the number of solutions of the Formula, as the product
+        of the number of solutions of each component
+        """
+        total = 1
+        for g, gvars in self.components:
+            total *= sum(1 for k in iter_models(g))
+        return total
+
+
+def split_clauses(clauses):
+    """
+    Splits clauses into groups that don't share any variable (with
+    union-find over the variables), and returns the list of groups
+    """
+    parent = {}
+
+    def find(var):
+        while parent.setdefault(var, var) != var:
+            parent[var] = parent[parent[var]]
+            var = parent[var]
+        return var
+
+    for clause in clauses:
+        root = find(abs(clause[0]))
+        for k in clause[1:]:
+            parent[find(abs(k))] = root
+
+    groups = {}
+    for clause in clauses:
+        groups.setdefault(find(abs(clause[0])), []).append(clause)
+    return list(groups.values())
+
+
+def decompose(f):
+    """
+    Runs unit propagation on the Formula and splits what is left into
+    independent components. Returns a Decomposition, or None if the
+    Formula has no solution. Every component is checked to have at
+    least one solution.
+
+    For eg. "^^ ( a b ) ?? ( c d ) e? ( f ) g" has g fixed and three
+    components: (a, b), (c, d) and (e, f).
+    """
+    value, clauses = propagate(f.clauses)
+    if value is None:
+        return None
+
+    n = len(f.flags)
+    components = []
+    used = set()
+    for group in split_clauses(clauses):
+        gvars = sorted(set(abs(k) for clause in group for k in clause))
+        used.update(gvars)
+        flags = [var for var in gvars if var <= n]
+        if not flags:
+            # Only auxiliary variables left, that don't change the
+            # flags. They just have to be satisfiable.
+            if pycosat.solve(group) == "UNSAT":
+                return None
+            continue
+
+        # Renumber: flags first, then the auxiliary variables
+        local = dict((var, i + 1) for i, var in
+                     enumerate(flags + [var for var in gvars if var > n]))
+        g = Formula([f.flags[var - 1] for var in flags])
+        g.nvars = len(local)
+        g.clauses = [[local[k] if k > 0 else -local[-k] for k in clause]
+                     for clause in group]
+        g.defined = f.defined
+        if pycosat.solve(g.clauses, vars=g.nvars) == "UNSAT":
+            return None
+        components.append((g, flags))
+
+    # Flags that are neither fixed nor in any clause are free
+    for var in range(1, n + 1):
+        if var not in value and var not in used:
+            components.append((Formula([f.flags[var - 1]]), [var]))
+
+    components.sort(key=lambda comp: comp[1][0])
+    fixed = dict((var, v) for var, v in value.items() if var <= n)
+    return Decomposition(f, fixed, components)
+
+
+def itersolve(req_use, limit=None, project=None):
+    """
+    Generator over the valid USE flag combinations of req_use, in
+    the same format as the elements of the list returned by main.
+
+    Solutions are only searched for and translated when they are
+    consumed, and at most `limit` of them are produced (all of
+    them if limit is None), so callers that need only a few of
+    the combinations don't pay for the rest.
+
+    `project` forces (or with False, disables) enumeration projected
+    on the flags, see iter_models.
+    """
+    if limit is not None and limit <= 0:
+        return
     if req_use.strip() == '':
-        return [[]]
-    # REQUIRED_USE variable value for which the combinations
-    # are being generated
-
-    # If flags aren't provided, match words from REQUIRED_USE
-    flags = re.findall(r'\w+', req_use)
-
-    # Remove duplicates
-    flags = list(set(flags))
-    # sort reverse to length (so that they can be replaced in
-    # this order by numbers later)
-    flags = sorted(flags, key=len)
-    flags.reverse()
+        yield []
+        return
+
+    f = compile_cnf(req_use)
+    d = decompose(f)
+    if d is None:
+        return
+
+    # Auxiliary variables are defined by the flags, so each solution
+    # has a distinct set of flags
+    count = 0
+    for soln in d.itersolve(project):
+        yield f.translate(soln)
+        count += 1
+        if count == limit:
+            return
+
+
+def optimize(f, maximize=False):
+    """
+    Returns the pycosat solution of the Formula with the fewest
+    (or with maximize, the most) enabled flags, or None if it has
+    no solution.
+
+    Binary search over the number of enabled flags: every step adds
+    an at_most_k bound to a copy of the formula and checks if it can
+    still be satisfied. Takes O(log(number of flags)) solver calls,
+    however many solutions there are.
+    """
+    n = len(f.flags)
+    soln = pycosat.solve(f.clauses, vars=f.nvars)
+    if soln == "UNSAT":
+        return None
+
+    # When maximizing, count (and bound) the disabled flags instead
+    sign = -1 if maximize else 1
+    lits = [sign * (i + 1) for i in range(n)]
+    cost = lambda soln: sum(1 for k in soln[:n] if k * sign > 0)
+
+    best, low, high = soln, 0, cost(soln)
+    while low < high:
+        mid = (low + high) // 2
+        g = f.copy()
+        at_most_k(g, lits, mid)
+        soln = pycosat.solve(g.clauses, vars=g.nvars)
+        if soln == "UNSAT":
+            low = mid + 1
+        else:
+            best, high = soln, cost(soln)
+    return best
+
+
+def xor_gate(f, a, b):
+    """
+    Returns a literal that is true exactly when one of a and b is
+    true. x <-> a ^ b is defined by the four clauses
+        (-x | a | b) & (-x | -a | -b) & (x | -a | b) & (x | a | -b)
+    """
+    x = f.new_var()
+    f.clauses.extend([[-x, a, b], [-x, -a, -b], [x, -a, b], [x, a, -b]])
+    return x
+
+
+# Chance of each flag being part of a random XOR constraint. Dense
+# (1/2) XORs give the best uniformity, but long XOR chains are very
+# hard for the SAT solver. Sparse XORs are an order of magnitude
+# faster on large groups and still come out close to uniform.
+XOR_DENSITY = 0.25
+
+
+def add_random_xor(f, rng, density=XOR_DENSITY):
+    """
+    Adds a random parity constraint over the flags to the Formula:
+    every flag is picked with probability `density`, and the XOR of
+    the picked flags is forced to a random value. Each such
+    constraint cuts the solution space roughly in half.
+    """
+    lits = [i + 1 for i in range(len(f.flags)) if rng.random() < density]
+    parity = rng.random() < 0.5
+    if not lits:
+        # XOR of nothing is false
+        if parity:
+            f.clauses.append([])
+        return
+    x = lits[0]
+    for lit in lits[1:]:
+        x = xor_gate(f, x, lit)
+    f.clauses.append([x] if parity else [-x])
+
+
+# Largest number of solutions a cell may have to be sampled from.
+# Higher values are closer to uniform, but need more solver calls.
+SAMPLE_PIVOT = 16
+
+
+def sample(req_use, count=1, seed=None, pivot=SAMPLE_PIVOT):
+    """
+    Returns `count` valid combinations of req_use (in the format of
+    the solutions returned by main), drawn near uniformly at random
+    from all the valid combinations without enumerating them.
+
+    If there are at most `pivot` solutions, one of them is picked
+    directly. Otherwise random XOR constraints are added until the
+    remaining cell has between 1 and `pivot` solutions, and one of
+    those is picked (hashing based sampling, as in UniGen).
+
+    The same seed always gives the same samples.
+    """
+    # Samples are only worth caching if they can be reproduced
+    if cache is not None and seed is not None:
+        return cache.memoize('sample', req_use, [count, seed, pivot],
+                             lambda: draw_samples(req_use, count, seed, pivot))
+    return draw_samples(req_use, count, seed, pivot)
+
+
+def draw_samples(req_use, count, seed, pivot):
+    """
+    The sampler behind sample, without the cache. Every component
+    is sampled on its own, which is just as uniform, and much
+    cheaper than hashing the whole solution space.
+    """
+    rng = random.Random(seed)
+    if req_use.strip() == '':
+        return [[] for i in range(count)]
+    f = compile_cnf(req_use)
+    d = decompose(f)
+    if d is None:
+        return []
+
+    parts = [sample_formula(g, count, rng, pivot) for g, gvars in d.components]
+    return [f.translate(d.assemble([k[i] for k in parts])) for i in range(count)]
+
+
+def sample_formula(f, count, rng, pivot):
+    """
+    Returns `count` near uniform random solutions (in pycosat form)
+    of a Formula that has at least one solution
+    """
+    # Small solution spaces are sampled exactly
+    solns = list(itertools.islice(iter_models(f), pivot + 1))
+    if len(solns) <= pivot:
+        return [rng.choice(solns) for i in range(count)]
+
+    output = []
+    xors = 1
+    while len(output) < count:
+        g = f.copy()
+        for i in range(xors):
+            add_random_xor(g, rng)
+        cell = list(itertools.islice(iter_models(g), pivot + 1))
+
+        if len(cell) > pivot:
+            # Cell too big, cut it further
+            xors += 1
+        elif not cell:
+            # Cut too deep, back off (or just try another hash)
+            xors = max(1, xors - 1)
+        else:
+            output.append(rng.choice(cell))
+    return output
+
+
+def extreme_enabled(req_use, maximize):
+    """
+    Solves for the combination of req_use with the fewest (or with
+    maximize, the most) enabled flags
+    """
+    if req_use.strip() == '':
+        return []
+    f = compile_cnf(req_use)
+    d = decompose(f)
+    if d is None:
+        return None
+
+    # The number of enabled flags adds up over the components, so
+    # each of them can be optimized on its own
+    return f.translate(d.assemble([optimize(g, maximize)
+                                   for g, gvars in d.components]))
 
-    i = 1
-    dict = {}
-    rev_dict = {}
-    # Assign a number to each keyword (to send to pycosat as
-    # it accepts cnf in form of numbers )
-    for k in flags:
-        dict[k] = i
-        rev_dict[i] = k
-        i += 1
-
-    # Generate the needed boolean expression
-    cnf_out = solve(req_use)
-
-    # str(object) gives a string in CNF form
-    cnf_str = str(cnf_out)
-
-    # Replace all flags with numerical equivalent
-    for key in flags:
-        cnf_str = cnf_str.replace(key, str(dict[key]))
-
-    # Convert to form needed by pycosat
-    cnf_str = cnf_str[1:-1]
-    cnf_lst = cnf_str.split(') & (')
-    for i in range(len(cnf_lst)):
-        cnf_lst[i] = [int(k) for k in cnf_lst[i].split(' | ')]
-
-    # Generate all possible solutions to the equation
-    k = (list(pycosat.itersolve(cnf_lst)))
-    for soln in k:
-        for i in range(0, len(soln)):
-            soln[i] = ( "-" if soln[i] < 0 else "" ) + rev_dict[abs(soln[i])]
-    return k
+
+def min_enabled(req_use):
+    """
+    Returns the valid combination of req_use with the fewest enabled
+    flags (in the format of the solutions returned by main), or None
+    if there is no valid combination
+    """
+    if cache is not None:
+        return cache.memoize('min', req_use, [],
+                             lambda: extreme_enabled(req_use, False))
+    return extreme_enabled(req_use, False)
+
+
+def max_enabled(req_use):
+    """
+    Returns the valid combination of req_use with the most enabled
+    flags, or None if there is no valid combination
+    """
+    if cache is not None:
+        return cache.memoize('max', req_use, [],
+                             lambda: extreme_enabled(req_use, True))
+    return extreme_enabled(req_use, True)
+
+
+class CountLimit(Exception):
+    """
+    Raised when exact model counting takes more than its budget
+    """
+
+
+# Largest number of branches the exact model counter may take on a
+# single component before falling back to an approximate count
+COUNT_BUDGET = 10000
+
+
+def count_exact(f, budget=COUNT_BUDGET):
+    """
+    Exact number of solutions of a Formula whose auxiliary variables
+    are all defined by the flags (so counting all the variables
+    counts the flags too).
+
+    DPLL style #SAT: unit propagation, free variables count twice,
+    independent components are counted separately and multiplied,
+    and every component's count is cached, so components that show
+    up again in other branches are not counted again. Raises
+    CountLimit after `budget` branches.
+    """
+    counted = {}
+    branches = [0]
+
+    def count(clauses, variables):
+        value, clauses = propagate(clauses)
+        if value is None:
+            return 0
+        used = set(abs(k) for clause in clauses for k in clause)
+        total = 2 ** len(variables - used - set(value))
+
+        for group in split_clauses(clauses):
+            key = tuple(sorted(tuple(sorted(clause)) for clause in group))
+            if key not in counted:
+                branches[0] += 1
+                if branches[0] > budget:
+                    raise CountLimit()
+                # Branch on the variable found in the most clauses
+                freq = {}
+                for clause in group:
+                    for k in clause:
+                        freq[abs(k)] = freq.get(abs(k), 0) + 1
+                var = max(freq, key=freq.get)
+                gvars = set(freq)
+                counted[key] = (count(group + [[var]], gvars) +
+                                count(group + [[-var]], gvars))
+            total *= counted[key]
+            if total == 0:
+                return 0
+        return total
+
+    return count(f.clauses, set(range(1, f.nvars + 1)))
+
+
+# Number of hashing rounds an approximate count takes the median of
+APPROX_TRIALS = 9
+
+
+def count_approx(f, rng, pivot=SAMPLE_PIVOT, trials=APPROX_TRIALS):
+    """
+    Approximate number of solutions of a Formula (as in ApproxMC):
+    add random XOR constraints until at most `pivot` solutions are
+    left, and scale that back up by 2 for every XOR. Returns the
+    median over a few rounds.
+
+    Dense XORs are used here, as sparse ones make the estimate drift.
+    """
+    estimates = []
+    for trial in range(trials):
+        xors = 1
+        while True:
+            g = f.copy()
+            for i in range(xors):
+                add_random_xor(g, rng, 0.5)
+            cell = len(list(itertools.islice(iter_models(g), pivot + 1)))
+            if cell <= pivot or xors >= len(f.flags):
+                break
+            xors += 1
+        estimates.append(cell * 2 ** xors)
+    estimates.sort()
+    return estimates[len(estimates) // 2]
+
+
+def count(req_use, iuse='', seed=None):
+    """
+    Returns the number of valid USE flag combinations of a package,
+    as a (count, exact) tuple, without enumerating them. Flags of
+    IUSE that REQUIRED_USE doesn't mention are counted too.
+
+    Every independent component is counted exactly if it fits in
+    COUNT_BUDGET branches, and approximately otherwise, in which
+    case `exact` is False.
+    """
+    flags = [k.lstrip('+-') for k in iuse.split()]
+    if cache is not None:
+        return tuple(cache.memoize('count', req_use, [flags, seed],
+                                   lambda: count_components(req_use, flags, seed)))
+    return count_components(req_use, flags, seed)
+
+
+def count_components(req_use, flags, seed):
+    """
+    Counts each component of req_use (plus the extra flags) and
+    multiplies the counts. This is count without the cache.
+    """
+    rng = random.Random(seed)
+    d = decompose(compile_cnf(req_use, flags))
+    if d is None:
+        return 0, True
+
+    total, exact = 1, True
+    for g, gvars in d.components:
+        try:
+            total *= count_exact(g)
+        except CountLimit:
+            total *= count_approx(g, rng)
+            exact = False
+    return total, exact
+
+
+def main(req_use, limit=None):
+    """
+    Returns the list of all valid USE flag combinations for the
+    REQUIRED_USE string (or the first `limit` of them)
+    """
+    if cache is not None:
+        return cache.memoize('solutions', req_use, [limit],
+                             lambda: list(itersolve(req_use, limit)))
+    return list(itersolve(req_use, limit))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class Timer(object):
+    """
+    Records how long each step of the startup of a service took,
+    counting from when it was created
+    For eg. "imports 0.21s, portage 2.84s, metadata 0.30s (3.35s)"
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.steps = []
+
+    def mark(self, step):
+        now = time.time()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self):
+        """
+        The steps and their durations in seconds, for /status
+        """
+        return {"steps": [[k, round(t, 3)] for k, t in self.steps],
+                "total": round(self.last - self.start, 3)}
+
+    def __str__(self):
+        return "%s (%.2fs)" % (
+            ", ".join("%s %.2fs" % k for k in self.steps),
+            self.last - self.start)
+
+
+# Started as soon as this module is imported, so services import it
+# before anything else that is slow to load
+timer = Timer()
+
+
+class LazyPortage(object):
+    """
+    Handles to portage and its tree that are only loaded the first
+    time they are used, since importing portage and building its
+    dbapi takes seconds
+    For eg. tree.db.xmatch("match-all", "app-misc/foo"),
+    tree.settings["USE"] or tree.portage.exception.InvalidAtom
+    """
+    def __init__(self, timer=None):
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.module = None
+        self.dbapi = None
+        self.load_time = None
+
+    def load(self):
+        with self.lock:
+            if self.module is None:
+                start = time.time()
+                import portage
+                # Save a reference to the portage tree
+                try:
+                    self.dbapi = portage.db[portage.root]["porttree"].dbapi
+                except KeyError:
+                    self.dbapi = portage.db[portage.root]["vartree"].dbapi
+                self.module = portage
+                self.load_time = time.time() - start
+                if self.timer is not None:
+                    self.timer.mark("portage")
+        return self.module
+
+    @property
+    def portage(self):
+        return self.load()
+
+    @property
+    def db(self):
+        self.load()
+        return self.dbapi
+
+    @property
+    def settings(self):
+        return self.load().settings
+
+    def use(self):
+        """
+        Active USE flags of the current environment
+        """
+        return self.settings["USE"].split()
+
+    def aux_get(self, cpv, keys):
+        return self.db.aux_get(cpv, keys)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTPServer handling every connection in a thread of its own, so
+    many callers are served at once and a slow one holds up nobody
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the discovery and dependency services. Every
+    reply carries the depth of the service's `pool`, and /status
+    reports it along with the startup steps. Subclasses set pool and
+    answer every other GET in handle_get().
+    """
+    # Keep-alive connections, closed after a minute without a request
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    pool = None
+
+    def reply(self, code, body, content_type='text/html'):
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Queue-Depth', str(self.pool.depth()))
+        if code == 503:
+            self.send_header('Retry-After', '10')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def status(self):
+        """
+        What /status reports, which subclasses add to
+        """
+        status = self.pool.status()
+        status["startup"] = timer.report()
+        return status
+
+    def priority(self):
+        """
+        The X-Priority of the request, lower running first (for eg. -1
+        for a stabilization request). 0 if it is missing or malformed.
+        """
+        try:
+            return int(self.headers.get("X-Priority", "0"))
+        except ValueError:
+            return 0
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(200, json.dumps(self.status()), 'application/json')
+            return
+        self.handle_get()
+
+
+def stop(signum, frame):
+    """
+    SIGTERM handler, to shut down the same way as on ^C
+    """
+    raise KeyboardInterrupt
+
+
+def shut_down(server, drain):
+    """
+    Stops accepting connections, then lets drain() wait for the jobs
+    that are still running
+    """
+    server.server_close()
+    if drain is not None:
+        left = drain()
+        if left:
+            print("Gave up on", left, "unfinished jobs")
+    sys.stdout.flush()
+
+
+def serve(server, workers=0, drain=None, forked=None):
+    """
+    Serves requests until SIGTERM or ^C, then shuts down gracefully:
+    the listening socket is closed and drain() is called to let the
+    jobs in flight finish.
+
+    With workers, this (warm) process forks that many children, which
+    accept connections on the same listening socket and share
+    everything loaded so far (portage, the metadata index, the solver
+    cache) copy-on-write. Each child calls forked() before serving, to
+    restart what does not survive a fork (for eg. the threads of a
+    WorkPool). A child that dies is replaced, and on SIGTERM or ^C
+    every child drains its own jobs before exiting.
+    """
+    signal.signal(signal.SIGTERM, stop)
+    if workers <= 0:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            shut_down(server, drain)
+        return
+
+    children = {}
+
+    def spawn(n):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                try:
+                    if forked is not None:
+                        forked()
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    shut_down(server, drain)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        children[pid] = n
+
+    try:
+        for n in range(workers):
+            spawn(n)
+        print("Forked", workers, "workers:", " ".join(str(k) for k in children))
+        sys.stdout.flush()
+        while True:
+            pid, status = os.wait()
+            n = children.pop(pid, None)
+            if n is not None:
+                print("Worker", pid, "exited with status", status,
+                      ", starting another one")
+                sys.stdout.flush()
+                # Don't spin if the workers die right away
+                time.sleep(1)
+                spawn(n)
+    except KeyboardInterrupt:
+        server.server_close()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+def run_service(handler, port, workers, drain, load):
+    """
+    Runs a service until SIGTERM or ^C: load() whatever it needs, bind
+    port and serve with handler (see serve).
+    """
+    timer.mark("imports")
+    # Load everything before forking, so the workers start warm and
+    # share it copy-on-write
+    load()
+
+    print('Starting httpserver on port', port)
+    sys.stdout.flush()
+    server = ThreadedHTTPServer(('', port), handler)
+    timer.mark("bind")
+    print('Started httpserver on port', port, 'in', timer)
+    sys.stdout.flush()
+    # On SIGTERM or ^C, stop accepting connections (new ones are refused,
+    # requests on connections already open get a 503) and give the jobs
+    # that were already accepted time to finish
+    serve(server, workers, drain,
+          handler.pool.forked if handler.pool is not None else None)
+    print('Shut down the web server')
+    sys.stdout.flush()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python2
+from __future__ import print_function
+import Queue
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Results of WorkPool.submit
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+FULL = "full"
+
+
+# Number of finished jobs whose timings are kept for status()
+RECENT = 50
+
+
+class WorkPool(object):
+    """
+    A fixed number of worker threads fed from a bounded queue. Jobs
+    have a key, and a job whose key is already queued or running is
+    coalesced with it instead of running twice.
+    For eg. pool.submit(("app-misc/foo-1.0", "a -b"), build_pretend,
+    "app-misc/foo-1.0", "a -b")
+
+    Queued jobs run by priority (lowest first), then in the order they
+    were submitted. With a gate (see flowcontrol.ResourceGate), a
+    worker only takes a job once the gate lets it, and holds its place
+    in the gate while it waits for one.
+    """
+    def __init__(self, workers, max_queue, gate=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.gate = gate
+        # Only taken in a forked child, to restart the pool once
+        self.restart = threading.Lock()
+        self.start()
+
+    def start(self):
+        """
+        (Re)creates the queue and the threads. Threads do not survive
+        a fork, so a forked child does this again, either right after
+        the fork (see startup.serve) or on its first submit.
+        """
+        self.queue = Queue.PriorityQueue(self.max_queue)
+        self.order = itertools.count()
+        self.recent = collections.deque(maxlen=RECENT)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.closed = False
+        self.threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work, name="worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        # Set last, so a submit that sees it finds the new queue
+        self.pid = os.getpid()
+
+    def forked(self):
+        """
+        Restarts the pool if this process was forked since it started.
+        Safe to call from many threads at once.
+        """
+        if self.pid != os.getpid():
+            with self.restart:
+                if self.pid != os.getpid():
+                    self.start()
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queues func(*args) unless a job with the same key is in flight.
+        Returns QUEUED, DUPLICATE, or FULL when the queue has no room
+        (the caller should ask again later). The job runs with the
+        priority keyword argument, 0 if not given.
+        """
+        priority = kwargs.get("priority", 0)
+        self.forked()
+        with self.lock:
+            if key in self.pending:
+                self.coalesced += 1
+                return DUPLICATE
+            if self.closed:
+                self.rejected += 1
+                return FULL
+            try:
+                self.queue.put_nowait((priority, next(self.order),
+                                       time.time(), key, func, args))
+            except Queue.Full:
+                self.rejected += 1
+                return FULL
+            self.pending.add(key)
+            return QUEUED
+
+    def work(self):
+        while True:
+            # Wait for the gate before taking a job, so that the job
+            # taken is the most urgent one once there is room for it
+            if self.gate is not None:
+                self.gate.acquire()
+            priority, order, queued, key, func, args = self.queue.get()
+            started = time.time()
+            with self.lock:
+                self.active += 1
+            try:
+                func(*args)
+                failed = False
+            except Exception:
+                print("Job", key, "failed", file=sys.stderr)
+                traceback.print_exc()
+                failed = True
+            finally:
+                if self.gate is not None:
+                    self.gate.release()
+            now = time.time()
+            with self.lock:
+                self.active -= 1
+                self.pending.discard(key)
+                self.recent.append({"key": key, "priority": priority,
+                                    "wait": round(started - queued, 3),
+                                    "run": round(now - started, 3),
+                                    "failed": failed})
+                if failed:
+                    self.failed += 1
+                else:
+                    self.done += 1
+            self.queue.task_done()
+
+    def depth(self):
+        """
+        Number of jobs queued or running
+        """
+        with self.lock:
+            return len(self.pending)
+
+    def status(self):
+        with self.lock:
+            return {
+                "jobs": len(self.pending),
+                "queued": self.queue.qsize(),
+                "active": self.active,
+                "workers": self.workers,
+                "max_queue": self.queue.maxsize,
+                "done": self.done,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "closed": self.closed,
+                "recent": list(self.recent),
+            }
+
+    def join(self):
+        """
+        Blocks until every queued job has run
+        """
+        self.queue.join()
+
+    def drain(self, timeout=None):
+        """
+        Stops taking new jobs (submit gives FULL) and waits for the
+        ones in flight, for at most timeout seconds. Returns the number
+        of jobs that did not finish in time.
+        """
+        with self.lock:
+            self.closed = True
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.depth() > 0:
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.1)
+        return self.depth()
@@ -212,30 +212,8 @@ func dep(w http.ResponseWriter, req *http.Request) {
 	fmt.Println("dep:", "Parent-Dependency combo", parent, "->", depend)
 
 	// Abort if any error has occured.
-	// Get the nodes for both parent and child
 	if err1 == nil && err2 == nil {
-		pnode := get(parent)
-		cnode := get(depend)
-
-		var result []struct {
-			_id bson.ObjectId `bson:"_id,omitempty"`
-			Cpv string        "Cpv"
-		}
-
-		db.Find(bson.M{"_id": bson.M{"$in": pnode.Dep}}).Select(
-			bson.M{"_id": 1, "Cpv": 1}).All(&result)
-		flag := false
-		// Check if dependency already exists in the tree
-		for _, depnode := range result {
-			if depnode.Cpv == depend {
-				flag = true
-				break
-			}
-		}
-		// If not, then add it and reavaluate the tree
-		if !flag {
-			db.Update(bson.M{"_id": pnode.Id}, bson.M{"$push": bson.M{"Dep": cnode.Id}})
-			fmt.Println("dep:", "Added", pnode.Cpv, "->", cnode.Cpv)
+		if pushDep(parent, depend) {
 			evaluate()
 		}
 		io.WriteString(w, "1")
@@ -244,6 +222,34 @@ func dep(w http.ResponseWriter, req *http.Request) {
 	}
 }
 
+// Adds the dependency parent -> depend to the tree (creating
+// the nodes if needed), unless it is already there. Returns
+// whether it was added, in which case the tree has to be
+// reevaluated.
+func pushDep(parent string, depend string) bool {
+	// Get the nodes for both parent and child
+	pnode := get(parent)
+	cnode := get(depend)
+
+	var result []struct {
+		_id bson.ObjectId `bson:"_id,omitempty"`
+		Cpv string        "Cpv"
+	}
+
+	db.Find(bson.M{"_id": bson.M{"$in": pnode.Dep}}).Select(
+		bson.M{"_id": 1, "Cpv": 1}).All(&result)
+	// Check if dependency already exists in the tree
+	for _, depnode := range result {
+		if depnode.Cpv == depend {
+			return false
+		}
+	}
+	// If not, then add it
+	db.Update(bson.M{"_id": pnode.Id}, bson.M{"$push": bson.M{"Dep": cnode.Id}})
+	fmt.Println("pushDep:", "Added", pnode.Cpv, "->", cnode.Cpv)
+	return true
+}
+
 // Function called to mark a particular package cpv as stable
 func mstable(w http.ResponseWriter, req *http.Request) {
 	fmt.Println("mstable:", "mstable called")
@@ -422,7 +428,19 @@ func flagTrigger() {
 			rand_num := rand.Intn(len(leaves))
 			url := base64.URLEncoding.EncodeToString([]byte(leaves[rand_num].Cpv))
 			url = "http://" + FLAG_SOLVER_IP + "/" + url
-			resp, err := http.Get(url)
+			req, _ := http.NewRequest("GET", url, nil)
+			// Packages with a stabilization request are solved first
+			if hasBug(leaves[rand_num].Cpv) {
+				req.Header.Set("X-Priority", "-1")
+			}
+			resp, err := http.DefaultClient.Do(req)
+			if err == nil && resp.StatusCode == http.StatusServiceUnavailable {
+				// The flag solver's queue is full, try again later
+				fmt.Println("flagTrigger:", "flag solver is busy")
+				resp.Body.Close()
+				time.Sleep(time.Minute * 1)
+				continue
+			}
 			text, err := ioutil.ReadAll(resp.Body)
 			if string(text) != "Ok!" {
 				fmt.Println("flagTrigger:", text)
@@ -537,6 +555,15 @@ func tempUrl(w http.ResponseWriter, req *http.Request) {
 	io.WriteString(w, url)
 }
 
+// Adds a combination of USE flags (separated by spaces)
+// to the real (State != 2) node of the package. Adding
+// a combination that is already there does nothing, so
+// requests doing this can safely be retried.
+func pushCombo(pkg string, flags string) error {
+	combo := strings.Split(flags, " ")
+	sort.Strings(combo)
+	return db.Update(bson.M{"Cpv": pkg, "State": bson.M{"$ne": 2}}, bson.M{"$addToSet": bson.M{"UseFlags": combo}})
+}
 func addCombo(w http.ResponseWriter, req *http.Request) {
 	fmt.Println("addCombo:", "addCombo called")
 	pkg := req.URL.Query().Get("package")
@@ -544,14 +571,11 @@ func addCombo(w http.ResponseWriter, req *http.Request) {
 
 	fmt.Println("Combo wants to add", pkg, "with", flags)
 
-	combo := strings.Split(flags, " ")
-	sort.Strings(combo)
-
 	var res []*Node
 
 	db.Find(bson.M{"Cpv": pkg, "State": bson.M{"$ne": 2}}).All(&res)
-	fmt.Println("The update seems to be applied to: ", res, "for combo", combo)
-	db.Update(bson.M{"Cpv": pkg, "State": bson.M{"$ne": 2}}, bson.M{"$push": bson.M{"UseFlags": combo}})
+	fmt.Println("The update seems to be applied to: ", res, "for combo", flags)
+	pushCombo(pkg, flags)
 	db.Find(bson.M{"Cpv": pkg, "State": bson.M{"$ne": 2}}).All(&res)
 	fmt.Println("The update seems to have been applied to: ", res[0])
 
@@ -559,6 +583,96 @@ func addCombo(w http.ResponseWriter, req *http.Request) {
 	evaluate()
 }
 
+// Bulk version of addCombo, for the file written by
+// FlagGenerator/batch.py. The body has one JSON object
+// per line: {"package": cpv, "combos": ["a -b", ...]}
+// Packages that are not in the tree yet are skipped.
+// Replies with the number of packages updated, or with a
+// 500 if any combo could not be stored.
+func importCombos(w http.ResponseWriter, req *http.Request) {
+	fmt.Println("importCombos:", "importCombos called")
+	dec := json.NewDecoder(req.Body)
+	updated := 0
+	failed := 0
+	var failure error
+	for {
+		var entry struct {
+			Package string   `json:"package"`
+			Combos  []string `json:"combos"`
+		}
+		err := dec.Decode(&entry)
+		if err == io.EOF {
+			break
+		}
+		if err != nil {
+			http.Error(w, err.Error(), http.StatusBadRequest)
+			return
+		}
+		stored := len(entry.Combos) > 0
+		for _, flags := range entry.Combos {
+			err = pushCombo(entry.Package, flags)
+			if err == nil {
+				continue
+			}
+			stored = false
+			if err != mgo.ErrNotFound {
+				failed++
+				failure = err
+			}
+		}
+		if stored {
+			updated++
+		}
+	}
+	fmt.Println("importCombos:", "Imported combos of", updated, "packages,", failed, "combos failed")
+	evaluate()
+	if failed > 0 {
+		http.Error(w, fmt.Sprintf("%d combos could not be stored, the last one with: %v", failed, failure), http.StatusInternalServerError)
+		return
+	}
+	io.WriteString(w, fmt.Sprint(updated))
+}
+
+// Everything the flag and dependency solvers found for a
+// package, in one request. The body is a JSON object
+// {"package": cpv, "combos": ["a -b", ...], "edges": [cpv, ...]}
+// where edges are the unstable dependencies of the package.
+// Either list may be missing. The tree is reevaluated once
+// at the end, and the reply is {"combos": n, "edges": m},
+// with the number of combos stored and of new edges.
+func bulk(w http.ResponseWriter, req *http.Request) {
+	fmt.Println("bulk:", "bulk called")
+	var entry struct {
+		Package string   `json:"package"`
+		Combos  []string `json:"combos"`
+		Edges   []string `json:"edges"`
+	}
+	if err := json.NewDecoder(req.Body).Decode(&entry); err != nil || entry.Package == "" {
+		http.Error(w, "expected {\"package\": ..., \"combos\": [...], \"edges\": [...]}", http.StatusBadRequest)
+		return
+	}
+	reply := struct {
+		Combos int `json:"combos"`
+		Edges  int `json:"edges"`
+	}{}
+	for _, flags := range entry.Combos {
+		if pushCombo(entry.Package, flags) == nil {
+			reply.Combos++
+		}
+	}
+	for _, depend := range entry.Edges {
+		if pushDep(entry.Package, depend) {
+			reply.Edges++
+		}
+	}
+	fmt.Println("bulk:", entry.Package, "got", reply.Combos, "combos and", reply.Edges, "new edges")
+	if reply.Combos > 0 || reply.Edges > 0 {
+		evaluate()
+	}
+	w.Header().Set("Content-Type", "application/json")
+	json.NewEncoder(w).Encode(reply)
+}
+
 func status(w http.ResponseWriter, req *http.Request) {
 	fmt.Println("status:", "status called")
 	pkg := req.URL.Query().Get("package")
@@ -586,6 +700,8 @@ func serverStart(c chan bool) {
 	r.HandleFunc("/request-package", rpack)
 	r.HandleFunc("/add-package", addpack)
 	r.HandleFunc("/add-combo", addCombo)
+	r.HandleFunc("/import-combos", importCombos).Methods("POST")
+	r.HandleFunc("/bulk", bulk).Methods("POST")
 	r.HandleFunc("/temp-upload-url", tempUrl)
 
 	// Custom http server
@@ -637,6 +753,16 @@ func prioritize(bug map[string]interface{}) {
 	//savePriority("/shared/data")
 }
 
+// Whether a stabilization request was filed for the package
+func hasBug(cpv string) bool {
+	for _, p := range priority {
+		if p.Cpv == cpv {
+			return true
+		}
+	}
+	return false
+}
+
 // This function triggers a TRAVIS build on request
 func trigger(cpv string) {
 	fmt.Println("trigger:", "trigger called")